@@ -1,4 +1,4 @@
-import os, sys, glob, shutil, json
+import os, sys, glob, shutil, json, functools
 os.environ["CUDA_VISIBLE_DEVICES"] = '0,1,2,3,4,5,6,7,8,9'
 import cv2
 
@@ -18,253 +18,87 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data.dataset import Dataset
-
-use_cuda = False
+from svhn_model import SVHN_Model1, MultiHeadLoss
+from svhn_dataset import SVHNDataset, build_image_cache
+from svhn_engine import predict_tta, decode_predictions
+from augment import BatchAugment
+from kfold import KFoldRunner
+from runtime import Runtime
+# 仓库根目录下的 common 包
+sys.path.append('../../..')
+from common.submission import write_submission
+from common.registry import DatasetRegistry
+from common.split import label_lengths, open_folds
+
+# 训练使用的设备与精度；没有 GPU 的 CPU 节点上可以打开 bf16 和 channels_last（加速比见 bench_runtime.py）
+runtime = Runtime('cpu', bf16=False, channels_last=False)
 my_test = False
 epoch_num = 4
+# 大于 0 时用多个进程同时训练各折（仅 CPU），每个进程分到 cpu_count // parallel_folds 个线程
+parallel_folds = 0
+# 由 svhn_dataset.py 预先生成的图片缓存，不存在时退回逐张解码 PNG
+TRAIN_CACHE = '../input/train_val_64x128.npy'
+TEST_CACHE = '../input/test_a_64x128.npy'
+train_cache = TRAIN_CACHE if os.path.exists(TRAIN_CACHE) else None
+test_cache = TEST_CACHE if os.path.exists(TEST_CACHE) else None
 
 from tensorboardX import SummaryWriter
 writer = SummaryWriter('logv9')
 
-# 定义读取数据集
-class SVHNDataset(Dataset):
-    def __init__(self, img_path, img_label, transform=None):
-        self.img_path = img_path
-        self.img_label = img_label 
-        if transform is not None:
-            self.transform = transform
-        else:
-            self.transform = None
-
-    def __getitem__(self, index):
-        img = Image.open(self.img_path[index]).convert('RGB')
-
-        if self.transform is not None:
-            img = self.transform(img)
-
-        # change
-        lbl = np.array(self.img_label[index][:4], dtype=np.int)
-        # 如果label不足5个，扩充为5个字符
-        lbl = list(lbl)  + (4 - len(lbl)) * [10]
-        return img, torch.from_numpy(np.array(lbl[:4]))
-
-    def __len__(self):
-        return len(self.img_path)
         
 # 定义读取数据Dataloader
-# glob.glob()获取指定路径下符合要求的文件路径
-train_path = glob.glob('../input/train/*.png')
-val_path = glob.glob('../input/val/*.png')
-image_path = train_path + val_path
-image_path.sort()
-
-train_json = json.load(open('../input/train.json'))
-train_label = [train_json[x]['label'] for x in train_json]
-val_json = json.load(open('../input/val.json'))
-val_label = [val_json[x]['label'] for x in val_json]
-image_label = train_label + val_label
-
-
-# 定义分类模型，使用ResNet18进行特征提取
-class SVHN_Model1(nn.Module):
-    def __init__(self):
-        super(SVHN_Model1, self).__init__()
-                
-        model_conv = models.resnet18(pretrained=True)
-        model_conv.avgpool = nn.AdaptiveAvgPool2d(1)
-        model_conv = nn.Sequential(*list(model_conv.children())[:-1])
-        self.cnn = model_conv
-        self.bn = nn.BatchNorm2d(512)
-        self.dp = nn.Dropout(0.5)
-        self.relu = nn.ReLU()
-        self.fc1 = nn.Linear(512, 11)
-        self.fc2 = nn.Linear(512, 11)
-        self.fc3 = nn.Linear(512, 11)
-        self.fc4 = nn.Linear(512, 11)
-        # self.fc5 = nn.Linear(512, 11)
-    
-    def forward(self, img):        
-        feat = self.cnn(img)
-        feat = self.bn(feat)
-        feat = self.dp(feat)
-        feat = self.relu(feat)
-        # print(feat.shape)
-        feat = feat.view(feat.shape[0], -1)
-        c1 = self.fc1(feat)
-        c2 = self.fc2(feat)
-        c3 = self.fc3(feat)
-        c4 = self.fc4(feat)
-        # c5 = self.fc5(feat)
-        return c1, c2, c3, c4
-        
-        
-# 训练与验证
-def train(train_loader, model, criterion, optimizer, epoch):
-    # 切换模型为训练模式
-    model.train()
-    train_loss = []
-    
-    for i, (input, target) in enumerate(train_loader):
-        # change
-        target = target.long()
-        if use_cuda:
-            input = input.cuda()
-            target = target.cuda()
-            
-        c0, c1, c2, c3 = model(input)
-        loss = criterion(c0, target[:, 0]) + \
-                criterion(c1, target[:, 1]) + \
-                criterion(c2, target[:, 2]) + \
-                criterion(c3, target[:, 3])
-                # criterion(c4, target[:, 4])
-        
-        # loss /= 6
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        
-        train_loss.append(loss.item())
-    return np.mean(train_loss)
+# train 和 val 的图片由 registry 统一编号（train 在前），数据集中第 i 个样本就是全局 id 为 i 的图片
+registry = DatasetRegistry([('train', 'train'), ('val', 'val')], root='../input')
+image_path = registry.paths()
 
-def validate(val_loader, model, criterion):
-    # 切换模型为预测模型
-    model.eval()
-    val_loss = []
-
-    # 不记录模型梯度信息
-    with torch.no_grad():
-        for i, (input, target) in enumerate(val_loader):
-            target = target.long()
-            if use_cuda:
-                input = input.cuda()
-                target = target.cuda()
-            
-            c0, c1, c2, c3 = model(input)
-            loss = criterion(c0, target[:, 0]) + \
-                    criterion(c1, target[:, 1]) + \
-                    criterion(c2, target[:, 2]) + \
-                    criterion(c3, target[:, 3])
-                    # criterion(c4, target[:, 4])
-            # loss /= 6
-            val_loss.append(loss.item())
-    return np.mean(val_loss)
-
-def predict(test_loader, model, tta=10):
-    model.eval()
-    test_pred_tta = None
-    
-    # TTA 次数
-    for _ in range(tta):
-        test_pred = []
-    
-        with torch.no_grad():
-            for i, (input, target) in enumerate(test_loader):
-                target = target.long()
-                if use_cuda:
-                    input = input.cuda()
-                
-                c0, c1, c2, c3 = model(input)
-                if use_cuda:
-                    output = np.concatenate([
-                        c0.data.cpu().numpy(), 
-                        c1.data.cpu().numpy(),
-                        c2.data.cpu().numpy(), 
-                        c3.data.cpu().numpy()], axis=1)
-                        # c4.data.cpu().numpy()], axis=1)
-                else:
-                    output = np.concatenate([
-                        c0.data.numpy(), 
-                        c1.data.numpy(),
-                        c2.data.numpy(), 
-                        c3.data.numpy()], axis=1)
-                        # c4.data.numpy()], axis=1)
-                
-                test_pred.append(output)
-        
-        test_pred = np.vstack(test_pred)
-        if test_pred_tta is None:
-            test_pred_tta = test_pred
-        else:
-            test_pred_tta += test_pred
-    
-    return test_pred_tta
+label_json = {'train': json.load(open('../input/train.json')),
+              'val': json.load(open('../input/val.json'))}
+image_label = [label_json[source][name]['label'] for source, name in map(registry.key, range(len(registry)))]
 
 
 model = SVHN_Model1()
-criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), 0.0005)
+criterion = MultiHeadLoss()
 best_loss = 1000.0
 
 
-if use_cuda:
-    model = model.cuda()
-
-for cv_idx in range(10):
-
-    begin = cv_idx * 4000
-
-    val_loader = torch.utils.data.DataLoader(
-        SVHNDataset(image_path[begin:(cv_idx+1) * 4000], image_label[begin:(cv_idx+1) * 4000],
-                    transforms.Compose([
-                        transforms.Resize((64, 128)),
-                        transforms.RandomCrop((50, 100)),
-                        transforms.Resize((64, 128)),
-                        # transforms.ColorJitter(0.3, 0.3, 0.2),
-                        transforms.RandomRotation(10),
-                        transforms.ToTensor(),
-                        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-                    ])),
-        batch_size=40,
-        shuffle=False,
-        num_workers=0,
-    )
-
-    train_loader = torch.utils.data.DataLoader(
-        SVHNDataset(image_path[0:begin] + image_path[(cv_idx+1) * 4000:], image_label[0:begin] + image_label[(cv_idx+1) * 4000:],
-                    transforms.Compose([
-                        transforms.Resize((64, 128)),
-                        transforms.RandomCrop((50, 100)),
-                        transforms.Resize((64, 128)),
-                        # transforms.ColorJitter(0.3, 0.3, 0.2),
-                        transforms.RandomRotation(10),
-                        transforms.ToTensor(),
-                        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-                    ])),
-        batch_size=40,
-        shuffle=True,
-        num_workers=0,
-    )
-
-
-    for epoch in tqdm(range(epoch_num)):
-        train_loss = train(train_loader, model, criterion, optimizer, epoch)
-        val_loss = validate(val_loader, model, criterion)
-        writer.add_scalar('Train/Loss', train_loss, epoch)
-        writer.add_scalar('Val/Loss', val_loss, epoch)
-
-        val_label = [''.join(map(str, x)) for x in val_loader.dataset.img_label]
-        val_predict_label = predict(val_loader, model, 1)
-        val_predict_label = np.vstack([
-            val_predict_label[:, :11].argmax(1),
-            val_predict_label[:, 11:22].argmax(1),
-            val_predict_label[:, 22:33].argmax(1),
-            val_predict_label[:, 33:44].argmax(1),
-            # val_predict_label[:, 44:55].argmax(1),
-        ]).T
-        val_label_pred = []
-        for x in val_predict_label:
-            val_label_pred.append(''.join(map(str, x[x!=10])))
-
-        val_char_acc = np.mean(np.array(val_label_pred) == np.array(val_label))
-        writer.add_scalar('Val/ACC', val_char_acc, epoch)
-        print('Epoch: {0}, Train loss: {1} \t Val loss: {2}'.format(epoch, train_loss, val_loss))
-        print('Val Acc', val_char_acc)
-
-        # 记录下验证集精度
-        if val_loss < best_loss:
-            best_loss = val_loss
-            # print('Find better model in Epoch {0}, saving model.'.format(epoch))
-            torch.save(model.state_dict(), './model_v9.pt')
+model = runtime.model(model)
+
+# K折交叉验证使用 train+val 的图片缓存
+if train_cache is None:
+    build_image_cache(image_path, TRAIN_CACHE)
+    train_cache = TRAIN_CACHE
+
+# 整个 train+val 只建一个数据集和一对 DataLoader，各折只修改采样的下标，每折从相同的初始权重开始训练
+kfold_augment = BatchAugment.from_compose(transforms.Compose([
+    transforms.Resize((64, 128)),
+    transforms.RandomCrop((50, 100)),
+    transforms.Resize((64, 128)),
+    # transforms.ColorJitter(0.3, 0.3, 0.2),
+    transforms.RandomRotation(10),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+]))
+# 验证集不传 val_augment，只做 resize + 归一化，选择最优 epoch 的指标和 OOF 每次运行都相同
+# 按字符长度分层、固定 seed 的10折划分，保存为 uint8 的 fold 数组，下标为 registry 的全局 id
+folds = open_folds('../input/folds_10.npy', label_lengths(image_label), n_splits=10, seed=0)
+runner = KFoldRunner(SVHNDataset(image_path, image_label, cache_path=train_cache), model,
+                     functools.partial(torch.optim.Adam, lr=0.0005), criterion,
+                     n_splits=10, batch_size=40, num_workers=4,
+                     train_augment=kfold_augment,
+                     folds=folds, oof_path='./oof_v9.npy', runtime=runtime)
+
+if parallel_folds > 0:
+    fold_results = runner.run_parallel(epoch_num, max_workers=parallel_folds)
+else:
+    fold_results = (runner.run_fold(cv_idx, epoch_num, writer) for cv_idx in range(10))
+
+# 各折最优 epoch 的验证集 logits 已写入 oof_v9.npy，可用于 stacking 或调整阈值
+for val_loss, val_char_acc, state, _, _ in fold_results:
+    # 记录下验证集精度
+    if val_loss < best_loss:
+        best_loss = val_loss
+        # print('Find better model, saving model.')
+        torch.save(state, './model_v9.pt')
 
 # 预测并生成提交文件
 test_path = glob.glob('../input/test_a/*.png')
@@ -277,6 +111,10 @@ if my_test:
     test_path = test_path[:10]
     test_label = test_label[:10]
 
+# predict_tta 在 batch 上做增强，测试集必须从 uint8 的图片缓存读取
+if test_cache is None:
+    build_image_cache(test_path, TEST_CACHE)
+    test_cache = TEST_CACHE
 
 test_loader = torch.utils.data.DataLoader(
     SVHNDataset(test_path, test_label,
@@ -287,7 +125,7 @@ test_loader = torch.utils.data.DataLoader(
                     # transforms.RandomRotation(5),
                     transforms.ToTensor(),
                     transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ])),
+    ]), cache_path=test_cache, batch_augment=True),
     batch_size=40,
     shuffle=False,
     num_workers=0,
@@ -296,24 +134,20 @@ test_loader = torch.utils.data.DataLoader(
 # 加载保存的最优模型
 model.load_state_dict(torch.load('model_v9.pt'))
 
-# 修改tta为10
-test_predict_label = predict(test_loader, model, 10)
+# tta为10：测试集本身的变换是确定的，每张图片在内存中扩展出10个随机裁剪+旋转的视图一起前向，
+# 随机参数由固定 seed 产生，结果可复现
+tta_augment = BatchAugment.from_compose(transforms.Compose([
+    transforms.Resize((64, 128)),
+    transforms.RandomCrop((60, 120)),
+    transforms.Resize((64, 128)),
+    transforms.RandomRotation(5),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+]))
+test_predict_label = predict_tta(test_loader, model, augment=tta_augment, views=10, seed=0, runtime=runtime)
 # print(test_predict_label.shape)
 
-test_label = [''.join(map(str, x)) for x in test_loader.dataset.img_label]
-test_predict_label = np.vstack([
-    test_predict_label[:, :11].argmax(1),
-    test_predict_label[:, 11:22].argmax(1),
-    test_predict_label[:, 22:33].argmax(1),
-    test_predict_label[:, 33:44].argmax(1),
-    # test_predict_label[:, 44:55].argmax(1),
-]).T
+test_label_pred = decode_predictions(test_predict_label)
 
-test_label_pred = []
-for x in test_predict_label:
-    test_label_pred.append(''.join(map(str, x[x!=10])))
-    
-import pandas as pd
-df_submit = pd.read_csv('../input/test_A_sample_submit.csv')
-df_submit['file_code'] = test_label_pred
-df_submit.to_csv('submit_v9.csv', index=None)
\ No newline at end of file
+# 按 test_A_sample_submit.csv 的顺序写出，并检查每张测试图片都有结果
+write_submission('submit_v9.csv', test_path, test_label_pred, '../input/test_A_sample_submit.csv')
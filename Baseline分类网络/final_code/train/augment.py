@@ -0,0 +1,192 @@
+import math
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def _uniform(n, low, high, generator):
+    return low + (high - low) * torch.rand(n, generator=generator)
+
+
+def _grayscale(img):
+    # 与 torchvision 的 rgb_to_grayscale 系数一致
+    return (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+
+
+class BatchAugment(object):
+    """在 CPU 上对整个 batch 做向量化的数据增强，输入为 uint8 的 (B, 3, H, W)。
+
+    每张图片的随机参数各自独立，默认顺序为 裁剪 -> 旋转 -> 颜色抖动 -> 归一化；rotate_first=True 时先旋转再裁剪，
+    jitter_first=True 时颜色抖动在裁剪和旋转之前。裁剪+Resize+旋转合并为一次双线性的 affine_grid/grid_sample，
+    与 torchvision 逐步插值的结果有细微差别。
+    """
+
+    def __init__(self, size=(64, 128), crop=None, center_crop=None, rotation=0,
+                 color_jitter=None, mean=MEAN, std=STD, rotate_first=False, jitter_first=False):
+        self.size = tuple(size)
+        # crop / center_crop 为输入图片上的像素大小 (h, w)，裁剪后再缩放到 size
+        self.crop = crop
+        self.center_crop = center_crop
+        self.rotation = rotation
+        # color_jitter 与 transforms.ColorJitter 的前三个参数相同: (brightness, contrast, saturation)
+        self.color_jitter = color_jitter
+        self.rotate_first = rotate_first
+        self.jitter_first = jitter_first
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    @classmethod
+    def from_compose(cls, compose, input_size=(64, 128)):
+        # 把各版本脚本里的 transforms.Compose 转成等价的批量增强，input_size 为缓存图片的大小
+        # 无法等价转换的变换（hue、padding、expand、重复的裁剪/旋转、夹在裁剪和旋转之间的颜色抖动等）直接报错
+        size = tuple(input_size)
+        kwargs = {}
+        # 已经出现的裁剪/旋转/颜色抖动，用来确定顺序
+        seen = []
+        rotation_size = None
+        for t in compose.transforms:
+            name = type(t).__name__
+            if isinstance(t, transforms.Resize):
+                if isinstance(t.size, int) or len(t.size) != 2:
+                    raise ValueError('Resize needs an (h, w) size, got {0}'.format(t.size))
+                size = tuple(t.size)
+            elif isinstance(t, (transforms.RandomCrop, transforms.CenterCrop)):
+                if 'crop' in seen:
+                    raise ValueError('BatchAugment supports a single crop, got a second {0}'.format(name))
+                if isinstance(t, transforms.RandomCrop) and (t.padding is not None or t.pad_if_needed):
+                    raise ValueError('RandomCrop padding is not supported by BatchAugment')
+                # 换算成在输入图片上的裁剪大小
+                crop = (int(round(t.size[0] * input_size[0] / size[0])),
+                        int(round(t.size[1] * input_size[1] / size[1])))
+                key = 'crop' if isinstance(t, transforms.RandomCrop) else 'center_crop'
+                kwargs[key] = crop
+                size = tuple(t.size)
+                seen.append('crop')
+            elif isinstance(t, transforms.RandomRotation):
+                if 'rotation' in seen:
+                    raise ValueError('BatchAugment supports a single RandomRotation')
+                if t.expand or t.center is not None or t.fill not in (0, None):
+                    raise ValueError('RandomRotation with expand/center/fill is not supported by BatchAugment')
+                if t.degrees[0] != -t.degrees[1]:
+                    raise ValueError('RandomRotation degrees must be symmetric, got {0}'.format(t.degrees))
+                kwargs['rotation'] = t.degrees[1]
+                rotation_size = size
+                seen.append('rotation')
+            elif isinstance(t, transforms.ColorJitter):
+                if 'jitter' in seen:
+                    raise ValueError('BatchAugment supports a single ColorJitter')
+                if t.hue is not None:
+                    raise ValueError('ColorJitter hue is not supported by BatchAugment')
+                kwargs['color_jitter'] = tuple(0 if r is None else r[1] - 1
+                                               for r in (t.brightness, t.contrast, t.saturation))
+                seen.append('jitter')
+            elif isinstance(t, transforms.Normalize):
+                kwargs['mean'], kwargs['std'] = t.mean, t.std
+            elif not isinstance(t, transforms.ToTensor):
+                raise ValueError('{0} is not supported by BatchAugment'.format(name))
+
+        geometric = [op for op in seen if op != 'jitter']
+        if 'jitter' in seen:
+            position = seen.index('jitter')
+            if 0 < position < len(seen) - 1:
+                raise ValueError('ColorJitter between crop and rotation is not supported by BatchAugment')
+            kwargs['jitter_first'] = position == 0 and len(geometric) > 0
+        kwargs['rotate_first'] = geometric == ['rotation', 'crop']
+        # 旋转在像素坐标下进行，旋转时图片的宽高比必须与实现中使用的一致（先旋转为输入图片，后旋转为输出图片）
+        if rotation_size is not None:
+            ref = input_size if kwargs['rotate_first'] else size
+            if rotation_size[0] * ref[1] != rotation_size[1] * ref[0]:
+                raise ValueError('RandomRotation at size {0} followed by a Resize to a different aspect ratio '
+                                 'is not supported by BatchAugment'.format(rotation_size))
+        return cls(size=size, **kwargs)
+
+    @staticmethod
+    def _rotation(angle, h, w):
+        # 大小为 (h, w) 的图片上的旋转，换算到归一化坐标需要考虑宽高比
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        return torch.stack([torch.stack([cos, -sin * h / w], 1),
+                            torch.stack([sin * w / h, cos], 1)], 1)
+
+    def _theta(self, n, h, w, generator):
+        # 输出的归一化坐标 p 映射到输入坐标: x = c + S * M * p
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = 1
+        theta[:, 1, 1] = 1
+
+        crop = self.crop or self.center_crop
+        if crop is not None:
+            ch, cw = crop
+            if self.crop is not None:
+                top = torch.floor(torch.rand(n, generator=generator) * (h - ch + 1))
+                left = torch.floor(torch.rand(n, generator=generator) * (w - cw + 1))
+            else:
+                top = torch.full((n,), float(round((h - ch) / 2.0)))
+                left = torch.full((n,), float(round((w - cw) / 2.0)))
+            theta[:, 0, 0] = cw / w
+            theta[:, 1, 1] = ch / h
+            theta[:, 0, 2] = (left + cw / 2.0) * 2 / w - 1
+            theta[:, 1, 2] = (top + ch / 2.0) * 2 / h - 1
+
+        if self.rotation:
+            angle = _uniform(n, -self.rotation, self.rotation, generator) * math.pi / 180
+            if self.rotate_first:
+                # 先在输入图片上旋转再裁剪: x = R * (c + S * p)
+                theta = torch.bmm(self._rotation(angle, h, w), theta)
+            else:
+                # 先裁剪再在输出图片上旋转: x = c + S * R * p
+                theta[:, :, :2] = torch.bmm(theta[:, :, :2], self._rotation(angle, *self.size))
+        return theta
+
+    def _color_jitter(self, img, generator):
+        n = img.shape[0]
+        brightness, contrast, saturation = self.color_jitter
+
+        def adjust_brightness(img, b):
+            return (img * b).clamp(0, 1)
+
+        def adjust_contrast(img, c):
+            m = _grayscale(img).mean(dim=(1, 2, 3), keepdim=True)
+            return ((img - m) * c + m).clamp(0, 1)
+
+        def adjust_saturation(img, s):
+            gray = _grayscale(img)
+            return ((img - gray) * s + gray).clamp(0, 1)
+
+        ops = []
+        for amount, fn in [(brightness, adjust_brightness), (contrast, adjust_contrast),
+                           (saturation, adjust_saturation)]:
+            factor = _uniform(n, max(0, 1 - amount), 1 + amount, generator).view(n, 1, 1, 1).to(img.device)
+            ops.append((amount, fn, factor))
+        # 与 transforms.ColorJitter 相同，每张图片按各自随机的顺序依次调整亮度、对比度、饱和度
+        order = torch.rand(n, 3, generator=generator).argsort(1).to(img.device)
+        for step in range(3):
+            out = img
+            for k, (amount, fn, factor) in enumerate(ops):
+                if amount:
+                    mask = (order[:, step] == k).view(n, 1, 1, 1)
+                    out = torch.where(mask, fn(img, factor), out)
+            img = out
+        return img
+
+    def __call__(self, img, generator=None):
+        if img.dtype != torch.uint8:
+            raise ValueError('BatchAugment expects uint8 images, got {0}'.format(img.dtype))
+        n, _, h, w = img.shape
+        img = img.float().div_(255)
+
+        if self.color_jitter is not None and self.jitter_first:
+            img = self._color_jitter(img, generator)
+
+        if self.crop or self.center_crop or self.rotation or (h, w) != self.size:
+            theta = self._theta(n, h, w, generator).to(img.device)
+            grid = F.affine_grid(theta, (n, 3) + self.size, align_corners=False)
+            img = F.grid_sample(img, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        if self.color_jitter is not None and not self.jitter_first:
+            img = self._color_jitter(img, generator)
+
+        return (img - self.mean.to(img.device)) / self.std.to(img.device)
@@ -0,0 +1,107 @@
+import sys
+import copy
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from svhn_model import load_model
+
+
+class ChannelAffine(nn.Module):
+    # eval 模式的 BatchNorm2d 等价于按通道的 x * scale + shift
+    def __init__(self, bn):
+        super(ChannelAffine, self).__init__()
+        scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', (bn.bias.detach() - bn.running_mean * scale).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x, self.scale)
+
+
+def _fold_conv_bn(module):
+    # ResNet 中的 BN 都紧跟在卷积后面：Sequential 中相邻的 (Conv2d, BatchNorm2d)（stem、downsample），
+    # 以及 BasicBlock 中的 convN / bnN，把 BN 合并进卷积的权重和偏置，BN 换成 Identity
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                module[i + 1] = nn.Identity()
+    for name, child in list(module.named_children()):
+        bn = getattr(module, 'bn' + name[4:], None) if name.startswith('conv') else None
+        if isinstance(child, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, name, fuse_conv_bn_eval(child, bn))
+            setattr(module, 'bn' + name[4:], nn.Identity())
+    for child in module.children():
+        _fold_conv_bn(child)
+
+
+def fold_model(model):
+    """返回只用于推理的 SVHN_Model1 副本：卷积后的 BN 全部合并进卷积，
+    尾部 bn -> dropout -> relu 中间隔着 ReLU 和池化，bn 换成按通道的仿射，dropout 去掉。
+    """
+    model = copy.deepcopy(model).eval()
+    _fold_conv_bn(model.cnn)
+    model.bn = ChannelAffine(model.bn)
+    model.dp = nn.Identity()
+    for m in model.modules():
+        if isinstance(m, (nn.BatchNorm2d, nn.Dropout)):
+            raise ValueError('{0} is left in the folded model'.format(type(m).__name__))
+    return model
+
+
+def export_model(model, export_path=None, batch_size=64):
+    # 用 (batch_size, 3, 64, 128) 的输入 trace，再 freeze，把参数作为常量并做常量折叠
+    example = torch.randn(batch_size, 3, 64, 128)
+    with torch.no_grad():
+        traced = torch.jit.trace(fold_model(model), example)
+    frozen = torch.jit.freeze(traced.eval())
+    if export_path is not None:
+        torch.jit.save(frozen, export_path)
+    return frozen
+
+
+def check_parity(model, exported, batch_size=64, atol=1e-3, seed=0):
+    # 同一批输入上比较 logits 的最大误差和每个位置的预测类别
+    input = torch.randn(batch_size, 3, 64, 128, generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        ref = model.eval()(input)
+        out = exported(input)
+    diff = (ref - out).abs().max().item()
+    agree = (ref.argmax(-1) == out.argmax(-1)).float().mean().item()
+    if diff > atol:
+        raise ValueError('exported logits differ by {0:.2e} (> {1:.0e})'.format(diff, atol))
+    return diff, agree
+
+
+def benchmark(model, batch_size=64, iters=20, warmup=5):
+    # 返回每个 batch 的平均耗时（毫秒）
+    input = torch.randn(batch_size, 3, 64, 128)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(input)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(input)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+if __name__ == '__main__':
+    # 用法: python export.py ../models/model_v31.pt [model_v31_cpu.pt]
+    # 推理时用 torch.jit.load 加载，输出与 SVHN_Model1 相同的 (B, heads, 11) logits
+    weight_path = sys.argv[1]
+    export_path = sys.argv[2] if len(sys.argv) > 2 else weight_path.replace('.pt', '_cpu.pt')
+
+    model = load_model(weight_path)
+    exported = export_model(model, export_path)
+    diff, agree = check_parity(model, exported)
+    print('Saved {0}, max logit diff {1:.2e}, argmax agreement {2:.4f}'.format(export_path, diff, agree))
+
+    for batch_size in (1, 64):
+        eager_ms = benchmark(model, batch_size)
+        export_ms = benchmark(exported, batch_size)
+        print('batch {0}: eager {1:.2f} ms ({2:.0f} img/s), exported {3:.2f} ms ({4:.0f} img/s), {5:.2f}x'.format(
+            batch_size, eager_ms, batch_size * 1000 / eager_ms, export_ms, batch_size * 1000 / export_ms,
+            eager_ms / export_ms))
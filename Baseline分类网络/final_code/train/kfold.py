@@ -0,0 +1,156 @@
+import os, copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from svhn_dataset import IndexSampler
+from augment import BatchAugment
+from svhn_engine import train, evaluate, decode_predictions, labels_to_codes
+from runtime import Runtime
+
+
+def kfold_indices(n, n_splits=10, seed=0):
+    # 只生成一次随机排列，第 k 折为排列中的第 k 段
+    perm = np.random.RandomState(seed).permutation(n)
+    return np.array_split(perm, n_splits)
+
+
+def open_oof(oof_path, n=None, width=44):
+    # 全量的 out-of-fold logits，第 i 行对应数据集中的第 i 个样本；n 不为空时新建（未写入的行为 nan）
+    if n is None:
+        return np.load(oof_path, mmap_mode='r+')
+    oof = np.lib.format.open_memmap(oof_path, mode='w+', dtype=np.float32, shape=(n, width))
+    oof[:] = np.nan
+    oof.flush()
+    return oof
+
+
+def _run_fold_process(runner, cv_idx, epoch_num, num_threads):
+    # 在子进程中运行一折，每个进程只使用 num_threads 个 CPU 线程，避免互相抢占
+    torch.set_num_threads(num_threads)
+    return runner.run_fold(cv_idx, epoch_num)
+
+
+class KFoldRunner(object):
+    """K 折交叉验证：整个 train+val 只建一个数据集和一对 DataLoader（persistent_workers），
+    每一折只修改采样器的下标；每折开始前从内存中缓存的初始权重重置模型并新建优化器，
+    各折之间互不影响，多折可以放到多个进程中同时运行（见 run_parallel）。
+
+    dataset 需要使用图片缓存且不带 transform，增强由 train_augment / val_augment 按 batch 完成；
+    val_augment 为空时验证集只做 resize + 归一化，用来选择最优 epoch 的 loss 和准确率每次运行都相同。
+    optimizer_fn 以 model.parameters() 为参数创建优化器，例如 functools.partial(torch.optim.Adam, lr=0.0005)。
+    folds 为每个样本所在折的编号（例如 common/split.py 按字符长度分层生成的 uint8 数组），
+    为空时按 seed 随机划分。
+    oof_path 不为空时，每折最优 epoch 的验证集 logits 按样本下标写入该 .npy（见 open_oof），
+    这份 logits 总是用确定性的 oof_augment 预测，与 val_augment 无关；
+    所有折跑完后得到整个 train+val 的 (N, heads*11) out-of-fold 矩阵。
+    """
+
+    def __init__(self, dataset, model, optimizer_fn, criterion, n_splits=10, seed=0, batch_size=40,
+                 num_workers=4, train_augment=None, val_augment=None, folds=None, oof_path=None,
+                 runtime=None):
+        self.dataset = dataset
+        self.model = model
+        self.optimizer_fn = optimizer_fn
+        self.criterion = criterion
+        self.train_augment = train_augment
+        # 只做 resize + 归一化，没有随机参数
+        self.oof_augment = BatchAugment()
+        self.val_augment = self.oof_augment if val_augment is None else val_augment
+        self.runtime = Runtime() if runtime is None else runtime
+        self.batch_size = batch_size
+        if folds is not None:
+            if len(folds) != len(dataset):
+                raise ValueError('folds has {0} entries but the dataset has {1} samples'.format(
+                    len(folds), len(dataset)))
+            folds = np.asarray(folds)
+            self.folds = [np.flatnonzero(folds == k) for k in range(n_splits)]
+        else:
+            self.folds = kfold_indices(len(dataset), n_splits, seed)
+        self.init_state = copy.deepcopy(model.state_dict())
+        self.oof_path = oof_path
+        if oof_path is not None:
+            open_oof(oof_path, len(dataset), dataset.label_len * 11)
+
+        persistent = num_workers > 0
+        self.train_sampler = IndexSampler([], shuffle=True, seed=seed)
+        self.train_loader = DataLoader(dataset, batch_size=batch_size, sampler=self.train_sampler,
+                                       num_workers=num_workers, persistent_workers=persistent)
+        self.val_sampler = IndexSampler([])
+        self.val_loader = DataLoader(dataset, batch_size=batch_size, sampler=self.val_sampler,
+                                     num_workers=num_workers, persistent_workers=persistent)
+
+    def __getstate__(self):
+        # 传给子进程时不带 DataLoader，子进程中重建（不再启动 worker，数据直接从 mmap 读取）
+        state = self.__dict__.copy()
+        del state['train_loader'], state['val_loader']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.train_loader = DataLoader(self.dataset, batch_size=self.batch_size, sampler=self.train_sampler)
+        self.val_loader = DataLoader(self.dataset, batch_size=self.batch_size, sampler=self.val_sampler)
+
+    def set_fold(self, cv_idx):
+        val_idx = np.sort(self.folds[cv_idx])
+        train_idx = np.concatenate([f for k, f in enumerate(self.folds) if k != cv_idx])
+        self.train_sampler.set_indices(train_idx)
+        self.val_sampler.set_indices(val_idx)
+        self.model.load_state_dict(self.init_state)
+        return val_idx
+
+    def run_fold(self, cv_idx, epoch_num, writer=None):
+        # 返回 (最优验证 loss, 对应的验证集准确率, 对应的权重, 验证集下标, 对应的确定性验证集 logits)
+        val_idx = self.set_fold(cv_idx)
+        optimizer = self.optimizer_fn(self.model.parameters())
+        val_label = labels_to_codes(self.dataset.label_table[val_idx].numpy())
+
+        best = (float('inf'), 0.0, None, val_idx, None)
+        for epoch in range(epoch_num):
+            train_loss = train(self.train_loader, self.model, self.criterion, optimizer, epoch,
+                               augment=self.train_augment, runtime=self.runtime)
+            val_loss, val_pred = evaluate(self.val_loader, self.model, self.criterion,
+                                          augment=self.val_augment, runtime=self.runtime)
+            val_char_acc = np.mean(np.array(decode_predictions(val_pred)) == np.array(val_label))
+
+            if writer is not None:
+                step = cv_idx * epoch_num + epoch
+                writer.add_scalar('Train/Loss', train_loss, step)
+                writer.add_scalar('Val/Loss', val_loss, step)
+                writer.add_scalar('Val/ACC', val_char_acc, step)
+            print('Fold: {0}, Epoch: {1}, Train loss: {2} \t Val loss: {3}'.format(
+                cv_idx, epoch, train_loss, val_loss))
+            print('Val Acc', val_char_acc)
+
+            if val_loss < best[0]:
+                state = {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()}
+                if self.val_augment is not self.oof_augment:
+                    # val_augment 带随机增强时，OOF 的 logits 再用确定性的增强预测一遍
+                    _, val_pred = evaluate(self.val_loader, self.model, self.criterion,
+                                           augment=self.oof_augment, runtime=self.runtime)
+                best = (val_loss, val_char_acc, state, val_idx, val_pred)
+
+        if self.oof_path is not None:
+            # 各折的验证集互不重叠，多个进程可以同时写同一个 memmap
+            oof = open_oof(self.oof_path)
+            oof[val_idx] = best[4]
+            oof.flush()
+            del oof
+        return best
+
+    def run_parallel(self, epoch_num, max_workers=2, num_threads=None, folds=None):
+        # 把各折分给 max_workers 个进程同时训练，返回按折顺序排列的 run_fold 结果
+        # 脚本没有 __main__ 保护，使用 fork 启动子进程，子进程直接继承已经加载的模块
+        if not self.runtime.is_cpu:
+            raise ValueError('run_parallel only supports CPU training')
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // max_workers)
+        if folds is None:
+            folds = range(len(self.folds))
+        with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_run_fold_process, self, cv_idx, epoch_num, num_threads)
+                       for cv_idx in folds]
+            return [future.result() for future in futures]
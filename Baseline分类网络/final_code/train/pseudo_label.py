@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from svhn_dataset import IndexSampler
+from svhn_engine import iter_predict
+
+
+def select_confident(position_conf, labels, thresholds=None, top_frac=None):
+    # position_conf: 每个位置 softmax 的最大值 (N, heads)，labels: 预测的类别 (N, heads)
+    # thresholds: 每个位置的置信度阈值，所有位置都达到阈值的样本才保留
+    # top_frac: 按预测的字符串长度分桶，每个桶内保留联合置信度最高的 top_frac 比例
+    keep = torch.ones(len(position_conf), dtype=torch.bool)
+    if thresholds is not None:
+        keep &= (position_conf >= torch.as_tensor(thresholds, dtype=position_conf.dtype)).all(1)
+    if top_frac is not None:
+        score = position_conf.prod(1)
+        length = (labels != 10).sum(1)
+        in_top = torch.zeros_like(keep)
+        for l in torch.unique(length):
+            bucket = torch.nonzero(length == l).view(-1)
+            k = int(np.ceil(len(bucket) * top_frac))
+            in_top[bucket[score[bucket].topk(k).indices]] = True
+        keep &= in_top
+    return np.flatnonzero(keep.numpy())
+
+
+class PseudoLabeler(object):
+    """伪标签训练：预测与训练的 DataLoader 只创建一次（persistent_workers），
+    标签保存在共享内存的 label_table 中，每轮原地更新，worker 直接读到新标签。
+
+    第一轮对全部样本打分；之后置信度已经很高的稳定样本复用缓存的 logits，
+    只对不稳定的样本以及按 refresh 比例轮换抽取的稳定样本重新打分。
+    thresholds / top_frac 见 select_confident，训练时只使用保留下来的样本。
+    dataset 需要使用图片缓存且不带 transform，增强由 predict_augment / train_augment 按 batch 完成。
+    """
+
+    def __init__(self, dataset, model, predict_augment, train_augment, batch_size=128, num_workers=4,
+                 stable_conf=0.9, refresh=0.1, thresholds=None, top_frac=None, seed=0, runtime=None):
+        if dataset.cache_path is None or dataset.transform is not None:
+            raise ValueError('PseudoLabeler needs an SVHNDataset with an image cache and no transform')
+        self.dataset = dataset
+        self.model = model
+        self.predict_augment = predict_augment
+        self.train_augment = train_augment
+        self.stable_conf = stable_conf
+        self.refresh_ratio = refresh
+        self.thresholds = thresholds
+        self.top_frac = top_frac
+        self.runtime = runtime
+        self.rng = np.random.RandomState(seed)
+
+        # worker 启动之前把标签表放进共享内存，之后主进程的原地修改对所有 worker 可见
+        dataset.label_table.share_memory_()
+
+        n = len(dataset)
+        self.logits = torch.zeros(n, dataset.label_len * 11)
+        # 每个位置 softmax 的最大值，样本的置信度为各位置的乘积
+        self.position_conf = torch.zeros(n, dataset.label_len)
+        self.confidence = torch.zeros(n)
+        self.scored = torch.zeros(n, dtype=torch.bool)
+        # 训练时使用的样本下标
+        self.keep = np.arange(n)
+
+        persistent = num_workers > 0
+        self.predict_sampler = IndexSampler(np.arange(n))
+        self.predict_loader = DataLoader(dataset, batch_size=batch_size, sampler=self.predict_sampler,
+                                         num_workers=num_workers, persistent_workers=persistent)
+        self.train_sampler = IndexSampler(np.arange(n), shuffle=True, seed=seed)
+        self.train_loader = DataLoader(dataset, batch_size=batch_size, sampler=self.train_sampler,
+                                       num_workers=num_workers, persistent_workers=persistent)
+
+    def _select(self):
+        if not self.scored.all():
+            return np.arange(len(self.dataset))
+        stable = (self.confidence >= self.stable_conf).numpy()
+        unstable_idx = np.flatnonzero(~stable)
+        stable_idx = np.flatnonzero(stable)
+        n_refresh = int(len(stable_idx) * self.refresh_ratio)
+        refresh_idx = self.rng.choice(stable_idx, n_refresh, replace=False)
+        return np.sort(np.concatenate([unstable_idx, refresh_idx]))
+
+    def refresh(self):
+        # 重新打分并原地更新伪标签，再按置信度筛选训练样本
+        # 返回 (重新打分的样本数, 标签发生变化的样本数, 保留用于训练的样本数)
+        idx = self._select()
+        self.predict_sampler.set_indices(idx)
+
+        changed = 0
+        start = 0
+        for logits in iter_predict(self.predict_loader, self.model,
+                                   augment=self.predict_augment, runtime=self.runtime):
+            logits = logits.float().cpu()
+            batch_idx = torch.from_numpy(idx[start:start + len(logits)])
+            start += len(logits)
+
+            conf, labels = torch.softmax(logits.view(len(logits), -1, 11), -1).max(-1)
+            changed += int((self.dataset.label_table[batch_idx] != labels).any(1).sum())
+            self.logits[batch_idx] = logits
+            self.position_conf[batch_idx] = conf
+            self.confidence[batch_idx] = conf.prod(1)
+            self.scored[batch_idx] = True
+            self.dataset.label_table[batch_idx] = labels
+
+        self.keep = select_confident(self.position_conf, self.dataset.label_table,
+                                     self.thresholds, self.top_frac)
+        self.train_sampler.set_indices(self.keep)
+        return len(idx), changed, len(self.keep)
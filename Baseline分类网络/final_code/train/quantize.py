@@ -0,0 +1,135 @@
+import io
+import os
+import sys
+import argparse
+import copy
+import json
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from svhn_model import load_model
+from svhn_dataset import SVHNDataset, IndexSampler, build_image_cache
+from svhn_engine import iter_predict, labels_to_codes, decode_predictions
+from augment import BatchAugment
+from export import benchmark
+# 仓库根目录下的 common 包
+sys.path.append('../../..')
+from common.registry import DatasetRegistry
+from common.split import label_lengths, open_folds
+
+INPUT_PATH = '../input'
+TRAIN_CACHE = f'{INPUT_PATH}/train_val_64x128.npy'
+calib_size = 1024
+batch_size = 64
+
+
+def default_backend():
+    # x86 用 fbgemm，ARM 上只有 qnnpack
+    return 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+
+def quantize_model(model, calib_loader, augment, backend=None):
+    """FX 静态量化：插入 observer 后在校准集上前向，统计激活的范围，再转换成 int8 模型。
+    conv+bn+relu 由 prepare_fx 自动融合，权重按通道量化。
+    """
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+    example = torch.randn(1, 3, 64, 128)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        for input, _ in calib_loader:
+            prepared(augment(input))
+    return convert_fx(prepared)
+
+
+def save_quantized(model, path):
+    # GraphModule 不能直接加载，trace + freeze 后保存，用 torch.jit.load 读取
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.randn(batch_size, 3, 64, 128))
+    torch.jit.save(torch.jit.freeze(traced.eval()), path)
+
+
+def saved_size(model):
+    # 保存后的字节数
+    buf = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buf)
+    else:
+        torch.save(model.state_dict(), buf)
+    return len(buf.getvalue())
+
+
+def split_indices(split, registry, folds):
+    """返回 (校准图片的候选 id, 评估图片的 id)。
+
+    split='val' 时评估原始 val 集、从 train 集中抽取校准图片，适用于只用 train 训练的模型；
+    split='foldK' 时评估 folds_10.npy 的第 K 折、从其余各折中抽取，只适用于训练时排除了第 K 折的模型。
+    评估的图片必须是模型训练时没有见过的，否则准确率偏高，也看不出量化带来的损失。
+    """
+    if split in registry.sources:
+        others = [s for s in registry.sources if s != split]
+        return np.concatenate([registry.source_ids(s) for s in others]), registry.source_ids(split)
+    if split.startswith('fold') and split[4:].isdigit():
+        k = int(split[4:])
+        return np.flatnonzero(folds != k), np.flatnonzero(folds == k)
+    raise ValueError('unknown split {0}, expected one of {1} or fold0..fold9'.format(split, registry.sources))
+
+
+def exact_match(loader, model, augment):
+    # 4个位置都预测正确（即整个字符串相同）的比例
+    codes = []
+    for output in iter_predict(loader, model, augment=augment):
+        codes += decode_predictions(output)
+    labels = labels_to_codes(loader.dataset.label_table[list(loader.sampler)].numpy())
+    return np.mean(np.array(codes) == np.array(labels))
+
+
+if __name__ == '__main__':
+    # 用法: python quantize.py ../models/model_v31.pt [model_v31_int8.pt] [--split val|foldK]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weight_path')
+    parser.add_argument('export_path', nargs='?')
+    parser.add_argument('--split', default='val',
+                        help="evaluation split the checkpoint never saw: 'val' (model trained on train only) "
+                             "or 'foldK' (model trained with fold K of folds_10.npy excluded)")
+    args = parser.parse_args()
+    weight_path = args.weight_path
+    export_path = args.export_path or weight_path.replace('.pt', '_int8.pt')
+    torch.set_num_threads(os.cpu_count())
+
+    registry = DatasetRegistry([('train', 'train'), ('val', 'val')], root=INPUT_PATH)
+    image_path = registry.paths()
+    label_json = {'train': json.load(open(f'{INPUT_PATH}/train.json')),
+                  'val': json.load(open(f'{INPUT_PATH}/val.json'))}
+    image_label = [label_json[source][name]['label'] for source, name in map(registry.key, range(len(registry)))]
+    if not os.path.exists(TRAIN_CACHE):
+        build_image_cache(image_path, TRAIN_CACHE)
+
+    # 与 Baseline_train_v9.py 相同的划分；校准图片从评估集以外按固定 seed 抽取
+    folds = np.asarray(open_folds(f'{INPUT_PATH}/folds_10.npy', label_lengths(image_label), n_splits=10, seed=0))
+    pool, val_idx = split_indices(args.split, registry, folds)
+    rng = np.random.RandomState(0)
+    calib_idx = rng.choice(pool, min(calib_size, len(pool)), replace=False)
+
+    dataset = SVHNDataset(image_path, image_label, cache_path=TRAIN_CACHE)
+    augment = BatchAugment()
+    calib_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=IndexSampler(calib_idx))
+    val_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=IndexSampler(val_idx))
+
+    model = load_model(weight_path)
+    backend = default_backend()
+    quantized = quantize_model(model, calib_loader, augment, backend)
+    save_quantized(quantized, export_path)
+    print('Saved {0} ({1}, calibrated on {2} images)'.format(export_path, backend, len(calib_idx)))
+    print("Evaluating on split '{0}': the accuracy is only valid if {1} was trained without it".format(
+        args.split, weight_path))
+
+    for name, m in [('fp32', model), ('int8', quantized)]:
+        acc = exact_match(val_loader, m, augment)
+        ms = benchmark(m, batch_size)
+        print('{0}: exact match {1:.4f} on {2} {3} images, {4:.0f} img/s, {5:.1f} MB'.format(
+            name, acc, len(val_idx), args.split, batch_size * 1000 / ms, saved_size(m) / 2 ** 20))
@@ -0,0 +1,51 @@
+import contextlib
+
+import torch
+
+
+class Runtime(object):
+    """训练和预测使用的设备与精度，代替以前各处的 use_cuda 和 .cuda()。
+
+    device 为 'cpu'、'cuda'、'cuda:1' 等；bf16=True 时前向和 loss 在 torch.autocast 下用 bfloat16 计算，
+    参数、梯度和优化器状态仍为 fp32；channels_last=True 时模型和输入使用 NHWC 布局，CPU 上 oneDNN 的卷积更快。
+    """
+
+    def __init__(self, device='cpu', bf16=False, channels_last=False):
+        self.device = torch.device(device)
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        if bf16 and self.device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            raise ValueError('{0} does not support bfloat16'.format(self.device))
+
+    @classmethod
+    def from_flags(cls, use_cuda=False, **kwargs):
+        # 兼容以前的 use_cuda 开关
+        return cls('cuda' if use_cuda else 'cpu', **kwargs)
+
+    @property
+    def is_cpu(self):
+        return self.device.type == 'cpu'
+
+    def model(self, model):
+        # 把模型移到 device 上，channels_last 时同时转换卷积权重的布局
+        model = model.to(self.device)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def to_device(self, tensor):
+        return tensor.to(self.device, non_blocking=True)
+
+    def format(self, input):
+        # 数据增强之后、送入模型之前调用
+        if self.channels_last and input.dim() == 4:
+            return input.contiguous(memory_format=torch.channels_last)
+        return input
+
+    def autocast(self):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=torch.bfloat16)
+
+    def __repr__(self):
+        return 'Runtime(device={0}, bf16={1}, channels_last={2})'.format(self.device, self.bf16, self.channels_last)
@@ -0,0 +1,161 @@
+import sys, glob, json
+
+from PIL import Image
+import numpy as np
+from tqdm import tqdm
+import torch
+from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
+
+from augment import BatchAugment
+
+# 预解码缓存的统一输入尺寸，与各版本 transforms.Resize((64, 128)) 保持一致
+CACHE_SIZE = (64, 128)
+
+
+def cache_index_path(cache_path):
+    return cache_path + '.json'
+
+
+def build_image_cache(img_path, cache_path, size=CACHE_SIZE):
+    # 一次性解码全部图片并 Resize 到固定大小，写入单个 uint8 的 .npy 文件，
+    # 图片 i 位于第 i 行，字节偏移为 header + i * H * W * 3
+    h, w = size
+    cache = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(img_path), h, w, 3))
+    for i, path in enumerate(tqdm(img_path)):
+        img = Image.open(path).convert('RGB').resize((w, h), Image.BILINEAR)
+        cache[i] = np.asarray(img)
+    cache.flush()
+    offset = cache.offset
+    del cache
+
+    # 索引文件记录每一行对应的原始路径，用来校验数据集顺序
+    with open(cache_index_path(cache_path), 'w') as f:
+        json.dump({'img_path': list(img_path), 'size': [h, w],
+                   'offset': offset, 'stride': h * w * 3}, f)
+
+
+def load_cache_index(cache_path):
+    with open(cache_index_path(cache_path)) as f:
+        return json.load(f)
+
+
+def encode_labels(img_label, max_len=4):
+    # 把变长的 label 列表一次性编码成 (N, max_len) 的 int64 张量，不足的位置补 10
+    if isinstance(img_label, (np.ndarray, torch.Tensor)) and img_label.ndim == 2:
+        # 伪标签等定长的预测结果，已经带有 10 的填充，直接截取
+        table = torch.full((len(img_label), max_len), 10, dtype=torch.int64)
+        n = min(max_len, img_label.shape[1])
+        table[:, :n] = torch.as_tensor(np.asarray(img_label)[:, :n], dtype=torch.int64)
+        return table
+
+    lens = np.array([min(len(x), max_len) for x in img_label], dtype=np.int64)
+    table = np.full((len(img_label), max_len), 10, dtype=np.int64)
+    # 把所有 label 拼成一维后按 (行, 列) 一次性写入
+    flat = np.fromiter((c for x in img_label for c in x[:max_len]), dtype=np.int64, count=lens.sum())
+    rows = np.repeat(np.arange(len(img_label)), lens)
+    cols = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    table[rows, cols] = flat
+    return torch.from_numpy(table)
+
+
+# 定义读取数据集
+class SVHNDataset(Dataset):
+    def __init__(self, img_path, img_label, transform=None, cache_path=None, label_len=4,
+                 batch_augment=False):
+        self.img_path = img_path
+        self.img_label = img_label
+        # label_len=5 对应旧版 Baseline.py 的5个分类头，v9之后为4个
+        self.label_len = label_len
+        self.label_table = encode_labels(img_label, label_len)
+        if transform is not None:
+            self.transform = transform
+        else:
+            self.transform = None
+
+        # cache_path 不为空时从预解码的 .npy 中读取图片，不再解码 PNG
+        self.cache_path = cache_path
+        self.cache = None
+        if cache_path is not None:
+            # 按路径查到缓存中的行号，img_path 可以是缓存的任意子集（如K折中的一折）
+            rows = {path: i for i, path in enumerate(load_cache_index(cache_path)['img_path'])}
+            missing = [path for path in img_path if path not in rows]
+            if missing:
+                raise ValueError('{0} images are missing from cache {1}, e.g. {2}'.format(
+                    len(missing), cache_path, missing[0]))
+            self.cache_rows = np.array([rows[path] for path in img_path], dtype=np.int64)
+
+        # batch_augment=True 时把 transform 换成在整个 batch 上执行的 BatchAugment，
+        # __getitem__ 只返回 uint8 图片，由 train/validate/predict 在取到 batch 后做增强
+        self.batch_augment = None
+        if batch_augment and cache_path is not None and self.transform is not None:
+            size = load_cache_index(cache_path)['size']
+            self.batch_augment = BatchAugment.from_compose(self.transform, size)
+            self.transform = None
+
+    def _open_cache(self):
+        # 每个 DataLoader worker 各自以只读方式 mmap，同一份文件通过 page cache 共享
+        if self.cache is None:
+            self.cache = np.load(self.cache_path, mmap_mode='r')
+        return self.cache
+
+    def __getstate__(self):
+        # memmap 被 pickle 时会复制全部数据，传给 worker 之前先丢掉
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self.cache_path is not None:
+            img = self._open_cache()[self.cache_rows[index]]
+            if self.transform is not None:
+                img = self.transform(Image.fromarray(img))
+            else:
+                # 不做变换时直接返回 uint8 的 (3, H, W) 张量
+                img = torch.from_numpy(np.array(img)).permute(2, 0, 1)
+        else:
+            img = Image.open(self.img_path[index]).convert('RGB')
+            if self.transform is not None:
+                img = self.transform(img)
+
+        return img, self.label_table[index]
+
+    def __len__(self):
+        return len(self.img_path)
+
+
+class IndexSampler(Sampler):
+    # indices 可以在两轮之间修改，DataLoader 和它的 worker 不需要重建
+    def __init__(self, indices, shuffle=False, seed=0):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.shuffle = shuffle
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def set_indices(self, indices):
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.indices), generator=self.generator).numpy()
+            return iter(self.indices[order].tolist())
+        return iter(self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
+if __name__ == '__main__':
+    # 用法: python svhn_dataset.py [INPUT_PATH]
+    # 生成 train+val 与 test_a 两份缓存，训练/推理脚本检测到缓存文件后会自动使用
+    INPUT_PATH = sys.argv[1] if len(sys.argv) > 1 else '../input'
+
+    train_path = glob.glob(f'{INPUT_PATH}/train/*.png')
+    val_path = glob.glob(f'{INPUT_PATH}/val/*.png')
+    image_path = train_path + val_path
+    image_path.sort()
+    build_image_cache(image_path, f'{INPUT_PATH}/train_val_64x128.npy')
+
+    test_path = glob.glob(f'{INPUT_PATH}/test_a/*.png')
+    test_path.sort()
+    build_image_cache(test_path, f'{INPUT_PATH}/test_a_64x128.npy')
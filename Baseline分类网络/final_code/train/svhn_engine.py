@@ -0,0 +1,215 @@
+import copy
+
+import numpy as np
+import torch
+
+from runtime import Runtime
+
+
+def _batch_augment(loader, augment):
+    # 没有显式传入时，使用数据集上配置的批量增强（见 SVHNDataset 的 batch_augment）
+    if augment is None:
+        augment = getattr(loader.dataset, 'batch_augment', None)
+    return augment
+
+
+# 类别 0-9 对应数字字符，10 表示该位置没有字符
+DIGITS = np.array([str(i) for i in range(10)] + [''])
+
+
+def logits_to_labels(test_pred):
+    # (N, heads*11) -> (N, heads)，一次 argmax 得到每个位置的类别
+    test_pred = torch.as_tensor(test_pred)
+    return test_pred.view(test_pred.shape[0], -1, 11).argmax(-1).cpu().numpy()
+
+
+def labels_to_codes(labels):
+    # 查表把类别转成字符，再按位置拼接，得到每张图片的字符串（去掉 10）
+    chars = DIGITS[np.asarray(labels)]
+    codes = chars[:, 0]
+    for k in range(1, chars.shape[1]):
+        codes = np.char.add(codes, chars[:, k])
+    return codes.tolist()
+
+
+def decode_predictions(test_pred):
+    return labels_to_codes(logits_to_labels(test_pred))
+
+
+def _logits(outputs):
+    # 多个分类头的输出 (c1, c2, ...) 拼成 (B, heads*11)
+    if isinstance(outputs, (tuple, list)):
+        return torch.cat(outputs, 1)
+    return outputs.reshape(outputs.shape[0], -1)
+
+
+def _runtime(runtime):
+    # 没有传入时在 CPU 上以 fp32 运行
+    return Runtime() if runtime is None else runtime
+
+
+# 训练与验证
+def train(train_loader, model, criterion, optimizer, epoch, augment=None, runtime=None):
+    # 切换模型为训练模式
+    model.train()
+    train_loss = []
+    augment = _batch_augment(train_loader, augment)
+    runtime = _runtime(runtime)
+
+    for i, (input, target) in enumerate(train_loader):
+        # change
+        target = runtime.to_device(target.long())
+        input = runtime.to_device(input)
+        if augment is not None:
+            input = augment(input)
+
+        with runtime.autocast():
+            outputs = model(runtime.format(input))
+            loss = criterion(outputs, target)
+
+        # loss /= 6
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        train_loss.append(loss.item())
+    return np.mean(train_loss)
+
+
+def evaluate(val_loader, model, criterion, augment=None, runtime=None):
+    # 一次遍历同时得到验证集 loss 和 (N, heads*11) 的 logits
+    # 切换模型为预测模型
+    model.eval()
+    val_loss = []
+    val_pred = None
+    start = 0
+    augment = _batch_augment(val_loader, augment)
+    runtime = _runtime(runtime)
+
+    # 不记录模型梯度信息
+    with torch.no_grad():
+        for i, (input, target) in enumerate(val_loader):
+            target = runtime.to_device(target.long())
+            input = runtime.to_device(input)
+            if augment is not None:
+                input = augment(input)
+
+            with runtime.autocast():
+                outputs = model(runtime.format(input))
+                loss = criterion(outputs, target)
+            # loss /= 6
+            val_loss.append(loss.item())
+
+            output = _logits(outputs)
+            if val_pred is None:
+                val_pred = torch.zeros(len(val_loader.sampler), output.shape[1], device=output.device)
+            val_pred[start:start + output.shape[0]] = output
+            start += output.shape[0]
+    return np.mean(val_loss), val_pred.cpu().numpy()
+
+
+def validate(val_loader, model, criterion, augment=None, runtime=None):
+    return evaluate(val_loader, model, criterion, augment=augment, runtime=runtime)[0]
+
+
+def predict(test_loader, model, tta=10, augment=None, runtime=None):
+    # 各轮 TTA 的 logits 直接累加到设备上预先分配的 (N, heads*11) 缓冲区
+    return predict_ensemble(test_loader, [model], tta, augment=augment, runtime=runtime)
+
+
+def iter_predict(test_loader, model, augment=None, runtime=None):
+    # 逐个 batch 产出 logits，调用方可以边预测边处理，不需要保存整个 (N, heads*11) 的结果
+    model.eval()
+    augment = _batch_augment(test_loader, augment)
+    runtime = _runtime(runtime)
+    with torch.no_grad():
+        for i, (input, target) in enumerate(test_loader):
+            input = runtime.to_device(input)
+            if augment is not None:
+                input = augment(input)
+            with runtime.autocast():
+                output = _logits(model(runtime.format(input)))
+            yield output.float()
+
+
+def _stacked_forward(models):
+    # 把结构相同的多个模型的参数堆叠起来，用 vmap 一次前向算出所有模型的输出之和
+    from torch.func import stack_module_state, functional_call, vmap
+
+    params, buffers = stack_module_state(models)
+    base = copy.deepcopy(models[0]).to('meta')
+
+    def call(p, b, x):
+        return _logits(functional_call(base, (p, b), (x,)))
+
+    forward = vmap(call, in_dims=(0, 0, None))
+    return lambda input: forward(params, buffers, input).sum(0)
+
+
+def predict_ensemble(test_loader, models, tta=1, augment=None, runtime=None, stacked=False):
+    # 每个 batch 只读取/增强一次，依次送入所有模型，logits 累加到预先分配的 (N, heads*11) 缓冲区
+    # test_loader 必须是 shuffle=False；stacked=True 时用 torch.func 把所有模型合并成一次前向
+    for model in models:
+        model.eval()
+    augment = _batch_augment(test_loader, augment)
+    runtime = _runtime(runtime)
+    forward = _stacked_forward(models) if stacked else None
+
+    test_pred = None
+    with torch.no_grad():
+        for _ in range(tta):
+            start = 0
+            for i, (input, target) in enumerate(test_loader):
+                input = runtime.to_device(input)
+                if augment is not None:
+                    input = augment(input)
+                input = runtime.format(input)
+
+                with runtime.autocast():
+                    if forward is not None:
+                        output = forward(input).float()
+                    else:
+                        output = _logits(models[0](input)).float()
+                        for model in models[1:]:
+                            output += _logits(model(input)).float()
+
+                if test_pred is None:
+                    test_pred = torch.zeros(len(test_loader.sampler), output.shape[1], device=output.device)
+                test_pred[start:start + output.shape[0]] += output
+                start += output.shape[0]
+
+    return test_pred.cpu().numpy()
+
+
+def predict_tta(test_loader, model, augment=None, views=10, seed=0, reduce='mean', runtime=None):
+    # 每张图片只读取一次，在内存中扩展出 views 个增强视图，作为一个大 batch 一次前向
+    # 随机参数由固定 seed 的 Generator 产生，结果可复现
+    # reduce='mean' 对 logits 取平均；reduce='geometric' 对每个位置的 softmax 取几何平均（返回 log 概率）
+    model.eval()
+    augment = _batch_augment(test_loader, augment)
+    if augment is None:
+        raise ValueError('predict_tta needs a BatchAugment and a loader yielding uint8 images')
+    runtime = _runtime(runtime)
+    generator = torch.Generator().manual_seed(seed)
+
+    test_pred = None
+    start = 0
+    with torch.no_grad():
+        for i, (input, target) in enumerate(test_loader):
+            input = runtime.to_device(input)
+            n = input.shape[0]
+            with runtime.autocast():
+                output = _logits(model(runtime.format(augment(input.repeat_interleave(views, 0), generator))))
+            output = output.float()
+            output = output.view(n, views, -1, 11)
+            if reduce == 'geometric':
+                output = torch.log_softmax(output, -1).mean(1)
+            else:
+                output = output.mean(1)
+
+            if test_pred is None:
+                test_pred = torch.zeros(len(test_loader.sampler), output.shape[1] * 11, device=output.device)
+            test_pred[start:start + n] = output.reshape(n, -1)
+            start += n
+
+    return test_pred.cpu().numpy()
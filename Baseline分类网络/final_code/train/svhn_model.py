@@ -0,0 +1,77 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.models as models
+
+
+# 定义分类模型，使用ResNet18进行特征提取
+# 放在单独的模块中，K折的子进程可以通过 pickle 重建模型
+class SVHN_Model1(nn.Module):
+    """heads 个位置的分类头合并成一个 Linear(512, heads*11)，一次矩阵乘法得到所有位置的 logits，
+    forward 返回 (B, heads, 11)。可以直接加载以前 fc1..fc4 分开保存的 state_dict。
+    """
+
+    def __init__(self, pretrained=True, dropout=0.5, heads=4):
+        super(SVHN_Model1, self).__init__()
+
+        model_conv = models.resnet18(pretrained=pretrained)
+        model_conv.avgpool = nn.AdaptiveAvgPool2d(1)
+        model_conv = nn.Sequential(*list(model_conv.children())[:-1])
+        self.cnn = model_conv
+        self.bn = nn.BatchNorm2d(512)
+        self.dp = nn.Dropout(dropout)
+        self.relu = nn.ReLU()
+        self.heads = heads
+        self.fc = nn.Linear(512, heads * 11)
+
+    def forward(self, img):
+        feat = self.cnn(img)
+        feat = self.bn(feat)
+        feat = self.dp(feat)
+        feat = self.relu(feat)
+        feat = feat.view(feat.shape[0], -1)
+        return self.fc(feat).view(feat.shape[0], self.heads, 11)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧模型的 fc1..fcN 按位置顺序拼接成 fc 的 weight (heads*11, 512) 和 bias (heads*11,)
+        old = [prefix + 'fc{0}.'.format(k + 1) for k in range(self.heads)]
+        if prefix + 'fc.weight' not in state_dict and old[0] + 'weight' in state_dict:
+            for name in ('weight', 'bias'):
+                state_dict[prefix + 'fc.' + name] = torch.cat([state_dict.pop(p + name) for p in old], 0)
+        super(SVHN_Model1, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class MultiHeadLoss(nn.Module):
+    """所有位置的交叉熵用一次 F.cross_entropy 在 (B*heads, 11) 上算出，再按位置加权求和。
+
+    weights 为每个位置的权重，为空时各位置权重为1，与逐个位置的 CrossEntropyLoss 相加相同。
+    outputs 也可以是旧模型返回的 (c1, c2, ...)。
+    """
+
+    def __init__(self, weights=None):
+        super(MultiHeadLoss, self).__init__()
+        self.register_buffer('weights', None if weights is None else torch.as_tensor(weights, dtype=torch.float32))
+
+    def forward(self, outputs, target):
+        if isinstance(outputs, (tuple, list)):
+            outputs = torch.stack(outputs, 1)
+        heads = outputs.shape[1]
+        loss = F.cross_entropy(outputs.reshape(-1, 11), target[:, :heads].reshape(-1), reduction='none')
+        loss = loss.view(-1, heads).mean(0)
+        if self.weights is not None:
+            if len(self.weights) != heads:
+                raise ValueError('got {0} position weights for {1} heads'.format(len(self.weights), heads))
+            loss = loss * self.weights.to(loss.device)
+        return loss.sum()
+
+
+def load_model(weight_path, map_location='cpu', **kwargs):
+    # 按 state_dict 中分类头的大小确定 heads（新的 fc 或旧的 fc1..fcN），返回 eval 模式的模型
+    state = torch.load(weight_path, map_location=map_location)
+    if 'fc.weight' in state:
+        heads = state['fc.weight'].shape[0] // 11
+    else:
+        heads = sum(1 for k in state if k.startswith('fc') and k.endswith('.weight'))
+    model = SVHN_Model1(pretrained=False, heads=heads, **kwargs)
+    model.load_state_dict(state)
+    return model.eval()
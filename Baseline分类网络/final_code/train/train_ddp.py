@@ -0,0 +1,183 @@
+import os, sys, json
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torchvision.transforms as transforms
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+
+from svhn_model import SVHN_Model1, MultiHeadLoss
+from svhn_dataset import SVHNDataset, IndexSampler, build_image_cache
+from svhn_engine import train, evaluate, decode_predictions, labels_to_codes
+from augment import BatchAugment
+from runtime import Runtime
+# 仓库根目录下的 common 包
+sys.path.append('../../..')
+from common.registry import DatasetRegistry
+from common.split import label_lengths, open_folds
+
+# 多进程 / 多机的数据并行训练（gloo 后端，CPU）
+# 单机 N 个进程:  python train_ddp.py N
+# 或:            torchrun --nproc_per_node=N train_ddp.py
+# 多机:          torchrun --nnodes=2 --node_rank=0 --master_addr=<节点0的地址> --master_port=29500 --nproc_per_node=N train_ddp.py
+#               （每个节点上运行一次，node_rank 分别为 0、1，各节点都需要有 ../input）
+INPUT_PATH = '../input'
+TRAIN_CACHE = f'{INPUT_PATH}/train_val_64x128.npy'
+epoch_num = 4
+# 每个进程的 batch 大小，总的 batch 为 batch_size * world_size
+batch_size = 40
+lr = 0.0005
+num_workers = 2
+# 与 Baseline_train_v9.py 相同的10折划分，第 val_fold 折做验证集
+val_fold = 0
+runtime = Runtime('cpu', bf16=False, channels_last=False)
+WEIGHT_PATH = 'model_ddp.pt'
+# 每个 epoch 结束时由 rank 0 保存，重新启动时所有进程从这里继续训练；已经训练完 epoch_num 个 epoch 时不再训练，需要删除或调大 epoch_num
+CHECKPOINT_PATH = 'checkpoint_ddp.pt'
+
+train_augment = BatchAugment.from_compose(transforms.Compose([
+    transforms.Resize((64, 128)),
+    transforms.RandomCrop((50, 100)),
+    transforms.Resize((64, 128)),
+    transforms.RandomRotation(10),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+]))
+val_augment = BatchAugment()
+
+
+def load_data(local_rank):
+    # 每个节点上的 local rank 0 各自生成图片缓存和 fold 划分（节点之间不要求共享文件系统），其余进程等它完成后再读取
+    registry = DatasetRegistry([('train', 'train'), ('val', 'val')], root=INPUT_PATH)
+    image_path = registry.paths()
+    label_json = {'train': json.load(open(f'{INPUT_PATH}/train.json')),
+                  'val': json.load(open(f'{INPUT_PATH}/val.json'))}
+    image_label = [label_json[source][name]['label'] for source, name in map(registry.key, range(len(registry)))]
+    if local_rank == 0:
+        if not os.path.exists(TRAIN_CACHE):
+            build_image_cache(image_path, TRAIN_CACHE)
+        open_folds(f'{INPUT_PATH}/folds_10.npy', label_lengths(image_label), n_splits=10, seed=0)
+    dist.barrier()
+    folds = np.asarray(open_folds(f'{INPUT_PATH}/folds_10.npy', label_lengths(image_label), n_splits=10, seed=0))
+    return SVHNDataset(image_path, image_label, cache_path=TRAIN_CACHE), folds
+
+
+def all_reduce_sum(values):
+    # 各进程的统计量求和，所有进程得到相同的结果
+    values = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    return values.tolist()
+
+
+def run(rank, world_size, local_rank, local_world_size):
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # 同一台机器上的进程平分 CPU 核心
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    torch.manual_seed(0)
+
+    dataset, folds = load_data(local_rank)
+    train_idx = np.flatnonzero(folds != val_fold)
+    val_idx = np.flatnonzero(folds == val_fold)
+    # 训练集由 DistributedSampler 每个 epoch 重新打乱后切分；验证集按下标交错切分，各进程之间不重复也不补齐，
+    # 汇总后的指标与单进程在整个验证集上的结果相同
+    train_set = Subset(dataset, train_idx)
+    train_sampler = DistributedSampler(train_set, world_size, rank, shuffle=True, seed=0)
+    train_loader = DataLoader(train_set, batch_size=batch_size, sampler=train_sampler,
+                              num_workers=num_workers, persistent_workers=num_workers > 0)
+    local_val_idx = val_idx[rank::world_size]
+    val_loader = DataLoader(dataset, batch_size=batch_size, sampler=IndexSampler(local_val_idx),
+                            num_workers=num_workers, persistent_workers=num_workers > 0)
+    val_label = labels_to_codes(dataset.label_table[local_val_idx].numpy())
+
+    model = runtime.model(SVHN_Model1())
+    criterion = MultiHeadLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr)
+    start_epoch = 0
+    best_loss = float('inf')
+    # checkpoint 只保存在 rank 0 所在的节点上，由 rank 0 读取后广播，所有进程从同一个 epoch 继续
+    checkpoint = [None]
+    if rank == 0 and os.path.exists(CHECKPOINT_PATH):
+        checkpoint = [torch.load(CHECKPOINT_PATH, map_location='cpu')]
+    dist.broadcast_object_list(checkpoint, 0)
+    checkpoint = checkpoint[0]
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        start_epoch = checkpoint['epoch'] + 1
+        best_loss = checkpoint['best_loss']
+        if rank == 0:
+            if start_epoch >= epoch_num:
+                print('{0} already finished {1} epochs (epoch_num = {2}), nothing to train; '
+                      'delete it or raise epoch_num to continue'.format(CHECKPOINT_PATH, start_epoch, epoch_num))
+            else:
+                print('Resuming from {0} at epoch {1}'.format(CHECKPOINT_PATH, start_epoch))
+    # DDP 初始化时把 rank 0 的参数广播给所有进程，backward 时用 all-reduce 平均梯度
+    ddp_model = DistributedDataParallel(model)
+
+    writer = None
+    if rank == 0:
+        from tensorboardX import SummaryWriter
+        writer = SummaryWriter('logddp')
+        print('world size {0}, {1} threads per process, {2} train / {3} val images, {4}'.format(
+            world_size, torch.get_num_threads(), len(train_idx), len(val_idx), runtime))
+
+    for epoch in range(start_epoch, epoch_num):
+        train_sampler.set_epoch(epoch)
+        train_loss = train(train_loader, ddp_model, criterion, optimizer, epoch,
+                           augment=train_augment, runtime=runtime)
+
+        # DDP 只在每次前向开始时广播 BN 的统计量，最后一个 batch 之后各进程不同；
+        # 验证前统一成 rank 0 的（即保存的模型），再只在本进程的那一份上前向
+        for buffer in model.buffers():
+            dist.broadcast(buffer, 0)
+        n = len(local_val_idx)
+        loss_sum, correct = 0.0, 0
+        # 验证集图片少于进程数时，有的进程分不到图片，只参与汇总
+        if n > 0:
+            _, val_pred = evaluate(val_loader, model, criterion, augment=val_augment, runtime=runtime)
+            val_pred = torch.from_numpy(val_pred).view(n, -1, 11)
+            loss_sum = criterion(val_pred, dataset.label_table[local_val_idx]).item() * n
+            correct = int(np.sum(np.array(decode_predictions(val_pred)) == np.array(val_label)))
+        train_loss_sum, loss_sum, correct, total = all_reduce_sum([train_loss, loss_sum, correct, n])
+        train_loss = train_loss_sum / world_size
+        val_loss = loss_sum / total
+        val_char_acc = correct / total
+        # 汇总后的指标在所有进程上相同，各进程的 best_loss 保持一致，只有 rank 0 写文件
+        is_best = val_loss < best_loss
+        best_loss = min(best_loss, val_loss)
+
+        if rank == 0:
+            writer.add_scalar('Train/Loss', train_loss, epoch)
+            writer.add_scalar('Val/Loss', val_loss, epoch)
+            writer.add_scalar('Val/ACC', val_char_acc, epoch)
+            print('Epoch: {0}, Train loss: {1} \t Val loss: {2}'.format(epoch, train_loss, val_loss))
+            print('Val Acc', val_char_acc)
+            if is_best:
+                torch.save(model.state_dict(), WEIGHT_PATH)
+            torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                        'epoch': epoch, 'best_loss': best_loss}, CHECKPOINT_PATH)
+
+    if writer is not None:
+        writer.close()
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def _spawn_worker(rank, world_size):
+    run(rank, world_size, rank, world_size)
+
+
+if __name__ == '__main__':
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # torchrun 已经设置好 MASTER_ADDR / MASTER_PORT / RANK / WORLD_SIZE
+        run(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']),
+            int(os.environ.get('LOCAL_RANK', os.environ['RANK'])),
+            int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE'])))
+    else:
+        nprocs = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(_spawn_worker, args=(nprocs,), nprocs=nprocs)
@@ -0,0 +1,128 @@
+# coding:utf-8
+import sys
+import json
+import struct
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+# 一个或多个模型在整个测试集上的检测结果，dets 为 (M, 6) 的 [x1, y1, x2, y2, score, label]，
+# image_ids 指向 names 中的图片，model_ids 为每个框来自的模型
+Detections = namedtuple('Detections', ['names', 'dets', 'image_ids', 'model_ids'])
+
+
+def save_detections(path, names, dets, counts=None, model_id=0):
+    """按列保存单个模型的检测结果（不压缩的 .npz）。
+
+    dets 可以是每张图片一个 (n_i, 6) 数组的列表，也可以是拼好的 (M, 6) 数组加上每张图片的框数 counts。
+    保存的列：boxes float32 (M, 4)，scores float32 (M,)，labels int8 (M,)，model_ids int8 (M,)，
+    offsets int64 (N+1,)（第 i 张图片的框为 offsets[i]:offsets[i+1]），names (N,)，
+    n_models（文件占用的模型编号数，即 model_id + 1，没有框时也有效）。
+    """
+    if counts is None:
+        counts = [len(d) for d in dets]
+        dets = np.concatenate([np.asarray(d, dtype=np.float64).reshape(-1, 6) for d in dets]) \
+            if len(dets) else np.zeros((0, 6))
+    dets = np.asarray(dets).reshape(-1, 6)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if offsets[-1] != len(dets):
+        raise ValueError('counts add up to {0} boxes but dets has {1}'.format(offsets[-1], len(dets)))
+    np.savez(path,
+             boxes=dets[:, :4].astype(np.float32),
+             scores=dets[:, 4].astype(np.float32),
+             labels=dets[:, 5].astype(np.int8),
+             model_ids=np.full(len(dets), model_id, dtype=np.int8),
+             offsets=offsets,
+             names=np.array(names, dtype=str),
+             n_models=np.int64(model_id + 1))
+
+
+def _mmap_npz(path):
+    # np.savez 不压缩，每个成员就是一个完整的 .npy，直接按它在 zip 中的偏移 mmap，不需要解压和复制
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            key = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[key] = np.load(zf.open(info))
+                continue
+            # zip 本地文件头为 30 字节，之后是文件名和扩展字段
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if np.prod(shape) == 0:
+                arrays[key] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[key] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                    order='F' if fortran else 'C')
+    return arrays
+
+
+def load_detections(paths):
+    """读取一个或多个 save_detections 保存的文件并拼接成一个 Detections。
+
+    各文件的图片按 names 对齐（以第一个文件的顺序为准），拼接后的框按图片排列，同一张图片内按文件顺序。
+    第 k 个文件的 model_ids 加上前面各文件的模型数（n_models），单模型文件的模型编号即为它在 paths 中的位置，
+    没有任何框的文件同样占一个编号。
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    names = None
+    dets, image_ids, model_ids = [], [], []
+    model_base = 0
+    for path in paths:
+        store = _mmap_npz(path)
+        file_names = np.asarray(store['names'])
+        counts = np.diff(store['offsets'])
+        if names is None:
+            names = file_names
+            index = np.arange(len(names))
+        elif np.array_equal(file_names, names):
+            index = np.arange(len(names))
+        else:
+            lookup = {name: i for i, name in enumerate(names.tolist())}
+            missing = [name for name in file_names.tolist() if name not in lookup]
+            if missing:
+                raise ValueError('{0} images in {1} are not in {2}, e.g. {3}'.format(
+                    len(missing), path, paths[0], missing[0]))
+            index = np.array([lookup[name] for name in file_names.tolist()], dtype=np.int64)
+
+        d = np.empty((len(store['scores']), 6))
+        d[:, :4] = store['boxes']
+        d[:, 4] = store['scores']
+        d[:, 5] = store['labels']
+        dets.append(d)
+        image_ids.append(np.repeat(index, counts))
+        file_models = np.asarray(store['model_ids'], dtype=np.int64)
+        model_ids.append(file_models + model_base)
+        # 旧文件没有 n_models 时按最大的 model_id 推算，至少占一个编号
+        if 'n_models' in store:
+            model_base += int(store['n_models'])
+        else:
+            model_base += int(file_models.max(initial=0)) + 1
+
+    dets = np.concatenate(dets)
+    image_ids = np.concatenate(image_ids)
+    model_ids = np.concatenate(model_ids)
+    order = np.argsort(image_ids, kind='stable')
+    return Detections(names.tolist(), dets[order], image_ids[order], model_ids[order])
+
+
+def json_to_store(json_path, store_path, model_id=0):
+    # 把旧格式的 {pic_name: [[x1, y1, x2, y2, score, label], ...]} 转成列存储
+    with open(json_path) as f:
+        load_dic = json.load(f)
+    names = list(load_dic.keys())
+    save_detections(store_path, names, [load_dic[k] for k in names], model_id=model_id)
+
+
+if __name__ == '__main__':
+    # 用法: python det_store.py r101.json r101.npz
+    json_to_store(sys.argv[1], sys.argv[2])
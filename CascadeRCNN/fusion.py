@@ -0,0 +1,145 @@
+# coding:utf-8
+import functools
+import multiprocessing
+
+import numpy as np
+
+from nms import pairwise_iou, group_bounds, iter_padded_groups, batched_nms
+
+METHODS = ('nms', 'soft_nms', 'wbf')
+
+
+def _padded_soft_nms(boxes, scores, valid, iou_thr, soft_method, sigma, score_thr):
+    # 每一步在每组剩下的框中取分数最高的，按 IoU 衰减同组其余框的分数，所有组同时进行
+    iou = pairwise_iou(boxes, boxes)
+    rows = np.arange(len(boxes))
+    scores = scores.copy()
+    done = ~valid
+    for _ in range(boxes.shape[1]):
+        cand = np.where(done, -np.inf, scores)
+        i = cand.argmax(1)
+        active = np.isfinite(cand[rows, i])
+        if not active.any():
+            break
+        done[rows[active], i[active]] = True
+
+        ovr = iou[rows, i]
+        if soft_method == 'linear':
+            decay = np.where(ovr > iou_thr, 1 - ovr, 1.0)
+        else:
+            decay = np.exp(-ovr * ovr / sigma)
+        scores = np.where(done | ~active[:, None], scores, scores * decay)
+        # 分数低于 score_thr 的框不再参与后面的选择
+        done |= scores < score_thr
+    return valid & (scores >= score_thr), scores
+
+
+def _padded_wbf(boxes, scores, valid, iou_thr):
+    # 按分数从高到低依次处理每组的第 j 个框：与已有融合框的最大 IoU > iou_thr 时并入该簇，否则新建一簇
+    # 融合框的坐标为簇内各框以分数加权的平均
+    g, k = valid.shape
+    rows = np.arange(g)
+    slots = np.arange(k)
+    fused = np.zeros((g, k, 4))
+    coord_sum = np.zeros((g, k, 4))
+    score_sum = np.zeros((g, k))
+    count = np.zeros((g, k), dtype=np.int64)
+    top = np.zeros((g, k), dtype=np.int64)
+    n = np.zeros(g, dtype=np.int64)
+    for j in range(k):
+        v = valid[:, j]
+        iou = pairwise_iou(boxes[:, j, None], fused)[:, 0]
+        iou = np.where(slots[None, :] < n[:, None], iou, -1)
+        best = iou.argmax(1)
+        matched = iou[rows, best] > iou_thr
+        target = np.where(matched, best, n)
+
+        r, t = rows[v], target[v]
+        coord_sum[r, t] += boxes[v, j] * scores[v, j, None]
+        score_sum[r, t] += scores[v, j]
+        count[r, t] += 1
+        fused[r, t] = coord_sum[r, t] / np.maximum(score_sum[r, t], 1e-12)[:, None]
+        new = v & ~matched
+        top[rows[new], n[new]] = j
+        n += new
+    return fused, score_sum, count, top, slots[None, :] < n[:, None]
+
+
+def _fuse(dets, group_ids, model_ids, method, iou_thr, weights, soft_method, sigma, score_thr):
+    # 返回融合后的框 (K, 6) 以及每个框对应的来源框下标（WBF 为簇内分数最高的框）
+    scores = dets[:, 4] * weights[model_ids]
+    if method == 'nms':
+        keep = batched_nms(np.c_[dets[:, :4], scores], group_ids, iou_thr)
+        out = dets[keep].copy()
+        out[:, 4] = scores[keep]
+        return out, keep
+
+    order = np.lexsort((-scores, group_ids))
+    starts, ends = group_bounds(group_ids[order])
+    sizes = ends - starts
+    boxes, scores = dets[order, :4], scores[order]
+    outs, srcs = [], []
+    for _, index, valid in iter_padded_groups(starts, sizes, np.arange(len(starts))):
+        if method == 'soft_nms':
+            keep, new_scores = _padded_soft_nms(boxes[index], scores[index], valid,
+                                                iou_thr, soft_method, sigma, score_thr)
+            src = order[index[keep]]
+            out = dets[src].copy()
+            out[:, 4] = new_scores[keep]
+        else:
+            fused, score_sum, count, top, exists = _padded_wbf(boxes[index], scores[index], valid, iou_thr)
+            # 置信度为簇内平均分，再按参与的模型数占比缩放，只被少数模型检测到的框分数降低
+            conf = score_sum / np.maximum(count, 1) * np.minimum(count, len(weights)) / weights.sum()
+            src = order[np.take_along_axis(index, top, 1)[exists]]
+            out = np.c_[fused[exists], conf[exists], dets[src, 5]]
+        outs.append(out)
+        srcs.append(src)
+    if not outs:
+        return np.zeros((0, 6)), np.zeros(0, dtype=np.int64)
+    src = np.concatenate(srcs)
+    out = np.concatenate(outs)
+    order = np.argsort(src, kind='stable')
+    return out[order], src[order]
+
+
+def fuse(dets, image_ids, model_ids=None, method='nms', iou_thr=0.4, weights=None, class_aware=False,
+         soft_method='gaussian', sigma=0.5, score_thr=0.001, processes=1):
+    """多模型检测结果融合。
+
+    dets 为所有模型、所有图片的框拼成的 (M, 6) 数组 [x1, y1, x2, y2, score, label]，
+    image_ids / model_ids 为每个框所属的图片和模型编号，weights 为各模型的权重（乘到分数上）。
+    method: 'nms' 硬 NMS；'soft_nms' 按 soft_method（'linear' / 'gaussian'）衰减重叠框的分数，
+    最后去掉分数低于 score_thr 的框；'wbf' weighted box fusion，重叠的框按分数加权平均成一个框。
+    class_aware=True 时只在同一类别的框之间融合。processes > 1 时按图片分块用多个进程并行。
+    返回 (融合后的框 (K, 6), 每个框所属的图片编号)。
+    """
+    if method not in METHODS:
+        raise ValueError('unknown fusion method {0}, expected one of {1}'.format(method, METHODS))
+    dets = np.asarray(dets, dtype=np.float64).reshape(-1, 6)
+    image_ids = np.asarray(image_ids, dtype=np.int64)
+    if model_ids is None:
+        model_ids = np.zeros(len(dets), dtype=np.int64)
+    model_ids = np.asarray(model_ids, dtype=np.int64)
+    if weights is None:
+        weights = np.ones(model_ids.max() + 1 if len(model_ids) else 1)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # 融合在组内进行，class_aware 时一组为 (图片, 类别)
+    group_ids = image_ids
+    if class_aware:
+        group_ids = image_ids * (int(dets[:, 5].max(initial=0)) + 1) + dets[:, 5].astype(np.int64)
+
+    run = functools.partial(_fuse, method=method, iou_thr=iou_thr, weights=weights,
+                            soft_method=soft_method, sigma=sigma, score_thr=score_thr)
+    if processes <= 1:
+        out, src = run(dets, group_ids, model_ids)
+        return out, image_ids[src]
+
+    # 按图片编号切成 processes 块，同一张图片的框只会落在一块中
+    chunks = np.array_split(np.unique(image_ids), processes)
+    masks = [np.isin(image_ids, chunk) for chunk in chunks if len(chunk)]
+    with multiprocessing.get_context('fork').Pool(len(masks)) as pool:
+        results = pool.starmap(run, [(dets[m], group_ids[m], model_ids[m]) for m in masks])
+    out = np.concatenate([r[0] for r in results])
+    fused_ids = np.concatenate([image_ids[m][r[1]] for m, r in zip(masks, results)])
+    return out, fused_ids
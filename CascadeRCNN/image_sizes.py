@@ -0,0 +1,68 @@
+# coding:utf-8
+import os
+import sys
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(pic_path):
+    # PNG 的第一个块必须是 IHDR：8 字节签名 + 4 字节长度 + b'IHDR' + 宽、高（大端 uint32），只读前 24 字节
+    with open(pic_path, 'rb') as f:
+        head = f.read(24)
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        # 不是 PNG 时才用 PIL 读文件头
+        from PIL import Image
+        return Image.open(pic_path).size
+    return struct.unpack('>II', head[16:24])
+
+
+def _png_sizes(paths):
+    return [png_size(path) for path in paths]
+
+
+def default_cache_path(image_path):
+    return os.path.normpath(image_path) + '_sizes.json'
+
+
+def scan_sizes(image_path, cache_path=None, num_threads=16):
+    """返回 image_path 下每张图片的 {文件名: (w, h)}。
+
+    结果缓存在 cache_path（默认与图片目录同级的 <目录名>_sizes.json）中，格式为 {文件名: [w, h, mtime]}，
+    再次运行时只重新读取新增或修改过的图片。
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(image_path)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    entries = [(e.name, e.path, e.stat().st_mtime) for e in os.scandir(image_path) if e.is_file()]
+    stale = [(name, path, mtime) for name, path, mtime in entries
+             if name not in cache or cache[name][2] != mtime]
+    if stale:
+        # 每个线程处理一段文件，减少逐个提交任务的开销
+        paths = [path for _, path, _ in stale]
+        step = max(1, -(-len(paths) // (num_threads * 4)))
+        with ThreadPoolExecutor(num_threads) as pool:
+            chunks = pool.map(_png_sizes, [paths[i:i + step] for i in range(0, len(paths), step)])
+            sizes = [size for chunk in chunks for size in chunk]
+        for (name, _, mtime), (w, h) in zip(stale, sizes):
+            cache[name] = [w, h, mtime]
+
+    names = set(name for name, _, _ in entries)
+    if stale or len(cache) != len(names):
+        # 删除已经不存在的图片后写回缓存
+        cache = {name: cache[name] for name in sorted(names)}
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f)
+    return {name: (cache[name][0], cache[name][1]) for name in names}
+
+
+if __name__ == '__main__':
+    # 用法: python image_sizes.py data/mchar_train/mchar_train data/mchar_val/mchar_val
+    for path in sys.argv[1:]:
+        print(path, len(scan_sizes(path)))
@@ -5,61 +5,92 @@
 from mmdet.apis import init_detector, inference_detector, show_result_pyplot
 import mmcv
 import os
-import pandas as pd
-import json
+from collections import deque
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from det_store import save_detections
+from postprocess import results_to_dets, select_boxes, render_codes
+# 仓库根目录下的 common 包
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.submission import write_submission
 
 
 config_file = './configs/cascade_rcnn/cascade_rcnn_r101_fpn_20e_coco.py'
 # download the checkpoint from model zoo and put it in `checkpoints/`
 checkpoint_file = './work_dirs/cascade_rcnn_r101_fpn_20e_coco/epoch_17.pth'
 
+# 没有 GPU 的机器上用 DEVICE=cpu python inference_demo.py
+device = os.environ.get('DEVICE', 'cuda:0')
+# 每次送入检测器的图片数，以及后台解码图片的线程数
+batch_size = 16
+num_threads = 4
+# 比赛提供的样例提交文件，用来校验结果的顺序和完整性；设为 None 时不校验
+sample_path = "data/test_A_sample_submit.csv"
+
 # build the model from a config file and a checkpoint file
-model = init_detector(config_file, checkpoint_file, device='cuda:0')
+model = init_detector(config_file, checkpoint_file, device=device)
+
+
+def test_scale(cfg):
+    # 测试 pipeline 中 MultiScaleFlipAug 的 img_scale，找不到时返回 None（不预先缩放）
+    for step in cfg.data.test.pipeline:
+        if step['type'] == 'MultiScaleFlipAug':
+            scale = step['img_scale']
+            return scale if isinstance(scale, tuple) else None
+    return None
+
+
+def load_image(pic_path, scale):
+    # 在线程中解码并按测试尺度缩放（cv2 会释放 GIL），返回图片和缩放比例，检测框最后再除以该比例
+    img = mmcv.imread(pic_path)
+    if scale is None:
+        return img, 1.0
+    return mmcv.imrescale(img, scale, return_scale=True)
+
 
+def prefetch_batches(paths, scale, pool, depth=2):
+    # 最多提前解码 depth 个 batch，检测器处理当前 batch 的同时后台线程准备下一个
+    pending = deque()
+    for begin in range(0, len(paths), batch_size):
+        pending.append([pool.submit(load_image, p, scale) for p in paths[begin:begin + batch_size]])
+        if len(pending) > depth:
+            yield [f.result() for f in pending.popleft()]
+    while pending:
+        yield [f.result() for f in pending.popleft()]
 
-d = {}
 
-df = pd.DataFrame(columns=['file_name','file_code'])
+# 每个 batch 的 (n, 6) [x1, y1, x2, y2, score, label] 数组和每张图片的框数，最后按列保存
+batch_dets = []
+batch_counts = []
+codes = []
+
 image_path = "data/mchar_test_a/mchar_test_a/"
 piclist = os.listdir(image_path)
 
 
 piclist.sort()
+pic_paths = [os.path.join(image_path, pic_name) for pic_name in piclist]
+scale = test_scale(model.cfg)
+
 index = 0
-for pic_name in piclist:
-    index += 1
-    if index % 1000 == 0:
-        print(f"{index}/40000")
-    pic_path = os.path.join(image_path, pic_name)
-    result = inference_detector(model, pic_path)
-    boxes = []
-    for i in range(10):
-        for box in result[i]:
-            copybox = box.tolist()
-            #copybox.append(i)
-
-            if i==9:
-                copybox.append(0)
-            else:
-                copybox.append(i+1)
-
-            if copybox[-2]>=0.4:
-                boxes.append(copybox)
-
-    boxes.sort(key=lambda x:x[0])
-
-    d[pic_name] = []
-
-    s = ""
-    for b in boxes:
-        s = s+str(b[-1])
-        d[pic_name].append(b)
-
-    if len(boxes)==0:
-        s="1"
-    df = df.append([{"file_name": pic_name, "file_code": s}], ignore_index=True)
-
-with open("r101.json","w") as f:
-    json.dump(d,f)
-
-df.to_csv("r101.csv",index=False)
\ No newline at end of file
+with ThreadPoolExecutor(num_threads) as pool:
+    for batch in prefetch_batches(pic_paths, scale, pool):
+        # 一次前向处理整个 batch，返回每张图片各类别的检测结果
+        results = inference_detector(model, [img for img, _ in batch])
+
+        # 整个 batch 一起处理：拼接各类别的框、换算坐标和标签、按置信度筛选、按 x1 排序后拼成字符串
+        dets, image_ids = results_to_dets(results, [factor for _, factor in batch])
+        dets, image_ids = select_boxes(dets, image_ids, 0.4)
+        batch_dets.append(dets)
+        batch_counts.append(np.bincount(image_ids, minlength=len(batch)))
+        codes += render_codes(dets[:, 5], image_ids, len(batch), empty="1")
+
+        index += len(batch)
+        if index // 1000 > (index - len(batch)) // 1000:
+            print(f"{index}/{len(piclist)}")
+
+save_detections("r101.npz", piclist, np.concatenate(batch_dets), np.concatenate(batch_counts))
+
+write_submission("r101.csv", piclist, codes, sample_path)
@@ -1,84 +1,43 @@
 # coding:utf-8
+import os
+import sys
 import numpy as np
-import json
-import pandas as pd
 
-jsonlist = ["r101.json",
-            "x101_32.json",
-            "x101_64.json"]
-
-with open(jsonlist[0]) as f:
-    load_dic = json.load(f)
-
-for jsonpath in jsonlist[1:]:
-    with open (jsonpath) as f:
-        temp_dic = json.load(f)
-        for k in load_dic.keys():
-            load_dic[k] += temp_dic[k]
-
-
-def py_cpu_nms(dets, thresh):
-    """Pure Python NMS baseline."""
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
-    scores = dets[:, 4]  # bbox打分
-
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    # 打分从大到小排列，取index
-    order = scores.argsort()[::-1]
-    # keep为最后保留的边框
-    keep = []
-    while order.size > 0:
-        # order[0]是当前分数最大的窗口，肯定保留
-        i = order[0]
-        keep.append(i)
-        # 计算窗口i与其他所有窗口的交叠部分的面积
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        # 交/并得到iou值
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        # inds为所有与窗口i的iou值小于threshold值的窗口的index，其他窗口此次都被窗口i吸收
-        inds = np.where(ovr <= thresh)[0]
-        # order里面只保留与窗口i交叠面积小于threshold的那些窗口，由于ovr长度比order长度少1(不包含i)，所以inds+1对应到保留的窗口
-        order = order[inds + 1]
-
-    return dets[keep]
-
-
-df = pd.DataFrame(columns=['file_name','file_code'])
-
-for picname in  load_dic.keys():
-    print(picname)
-    boxes = load_dic[picname]
-    if len(boxes)>1:
-        n = np.array(boxes[0])
-        for box in boxes[1:]:
-            n = np.vstack((n, np.array(box)))
-        keep = py_cpu_nms(n, 0.4)
-        keep = keep.tolist()
-        keep.sort(key=lambda x: x[0])
-
-        s = ""
-        for b in keep:
-            if b[-2]>=0.4:
-                s = s + str(int(b[-1]))
-
-        df = df.append([{"file_name": picname, "file_code": s}], ignore_index=True)
-
-    else:
-        s = ""
-        for b in boxes:
-            if b[-2] >= 0.2:
-                s = s + str(int(b[-1]))
-
-        df = df.append([{"file_name": picname, "file_code": s}], ignore_index=True)
-
-df.to_csv("submit.csv", index=False)
\ No newline at end of file
+from fusion import fuse
+from det_store import load_detections
+from postprocess import select_boxes, render_codes
+# 仓库根目录下的 common 包
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.submission import write_submission
+
+# inference_demo.py 保存的各模型检测结果，旧的 json 结果可以用 det_store.py 转换
+storelist = ["r101.npz",
+             "x101_32.npz",
+             "x101_64.npz"]
+# 各模型的权重，与 storelist 一一对应
+weights = [1, 1, 1]
+# 融合方式：'nms' / 'soft_nms' / 'wbf'，class_aware=True 时只融合同一类别的框
+method = 'nms'
+class_aware = False
+iou_thr = 0.4
+processes = 1
+# 比赛提供的样例提交文件，用来校验结果的顺序和完整性；设为 None 时不校验
+sample_path = "data/test_A_sample_submit.csv"
+
+# 所有模型、所有图片的框拼成一个 (M, 6) 的数组，image_ids / model_ids 记录每个框属于哪张图片、哪个模型，
+# 整个测试集一次融合
+names, dets, image_ids, model_ids = load_detections(storelist)
+counts = np.bincount(image_ids, minlength=len(names))
+
+dets, image_ids = fuse(dets, image_ids, model_ids, method=method, iou_thr=iou_thr, weights=weights,
+                       class_aware=class_aware, processes=processes)
+
+# 多个框的图片融合后保留置信度 >= 0.4 的框，只有一个框的图片阈值为 0.2
+# 同一张图片的框按 x1 从左到右排列后拼接标签
+thresh = np.where(counts[image_ids] > 1, 0.4, 0.2)
+dets, image_ids = select_boxes(dets, image_ids, thresh)
+codes = render_codes(dets[:, 5], image_ids, len(names))
+
+print(f"{len(names)} images, {len(dets)}/{counts.sum()} boxes kept ({method})")
+
+write_submission("submit.csv", names, codes, sample_path)
@@ -0,0 +1,120 @@
+# coding:utf-8
+import numpy as np
+
+
+def box_area(boxes):
+    # 与 py_cpu_nms 相同，宽高按像素计数（+1）
+    return (boxes[..., 2] - boxes[..., 0] + 1) * (boxes[..., 3] - boxes[..., 1] + 1)
+
+
+def pairwise_iou(a, b):
+    # a: (..., K, 4)  b: (..., L, 4)  ->  (..., K, L)
+    xx1 = np.maximum(a[..., :, None, 0], b[..., None, :, 0])
+    yy1 = np.maximum(a[..., :, None, 1], b[..., None, :, 1])
+    xx2 = np.minimum(a[..., :, None, 2], b[..., None, :, 2])
+    yy2 = np.minimum(a[..., :, None, 3], b[..., None, :, 3])
+    inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+    return inter / (box_area(a)[..., :, None] + box_area(b)[..., None, :] - inter)
+
+
+def sweep_nms(boxes, scores, thresh):
+    """单张图片的 NMS：按分数从大到小扫描，返回保留框的下标（按分数降序）。
+
+    分数相同的框按原来的先后顺序处理，与 batched_nms 中 lexsort 的顺序一致。
+    """
+    order = np.argsort(-scores, kind='stable')
+    boxes = boxes[order]
+    areas = box_area(boxes)
+    keep = []
+    alive = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if not alive[i]:
+            continue
+        keep.append(i)
+        # 只和后面仍然存活的框计算 IoU
+        rest = np.flatnonzero(alive[i + 1:]) + i + 1
+        xx1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        alive[rest[ovr > thresh]] = False
+    return order[keep]
+
+
+def py_cpu_nms(dets, thresh):
+    """Pure Python NMS baseline."""
+    return dets[sweep_nms(dets[:, :4], dets[:, 4], thresh)]
+
+
+def _padded_nms(boxes, valid, thresh):
+    # boxes: (G, K, 4) 每组已按分数降序排列，valid 标出填充位置
+    # 逐列贪心：第 j 个框仍保留时，抑制同组中排在它后面且 IoU > thresh 的框，所有组同时进行
+    iou = pairwise_iou(boxes, boxes)
+    later = np.triu(np.ones(iou.shape[1:], dtype=bool), 1)
+    over = (iou > thresh) & later
+    keep = valid.copy()
+    for j in range(boxes.shape[1] - 1):
+        keep &= ~(keep[:, j, None] & over[:, j])
+    return keep
+
+
+def group_bounds(image_ids):
+    # image_ids 已排序，返回每组的 [start, end)
+    starts = np.flatnonzero(np.r_[True, image_ids[1:] != image_ids[:-1]])
+    ends = np.r_[starts[1:], len(image_ids)]
+    return starts, ends
+
+
+def iter_padded_groups(starts, sizes, groups, max_elements=1 << 22):
+    """按框数排序后把 groups 分块，每块补齐到块内最大框数 K，块大小受 G*K*K <= max_elements 限制。
+
+    产出 (groups, index, valid)：index 为 (G, K) 的下标表，填充位置指向组内第一个框，valid 标出真实的框。
+    """
+    groups = groups[np.argsort(sizes[groups], kind='stable')]
+    begin = 0
+    while begin < len(groups):
+        end = begin + 1
+        while end < len(groups) and (end + 1 - begin) * sizes[groups[end]] ** 2 <= max_elements:
+            end += 1
+        block = groups[begin:end]
+        offset = np.arange(sizes[block[-1]])
+        valid = offset[None, :] < sizes[block, None]
+        index = starts[block, None] + np.where(valid, offset[None, :], 0)
+        yield block, index, valid
+        begin = end
+
+
+def batched_nms(dets, image_ids, thresh, max_group=64, max_elements=1 << 22):
+    """对整个测试集一次做 NMS。
+
+    dets 为所有图片所有框拼成的 (M, 6) 数组 [x1, y1, x2, y2, score, label]，
+    image_ids 为每个框所属图片的编号，返回保留框在 dets 中的下标（升序）。
+    框数不超过 max_group 的图片按框数分桶，同一桶的图片补齐后用 (G, K, K) 的 IoU 矩阵一起计算；
+    更大的图片逐张用 sweep_nms。
+    """
+    dets = np.asarray(dets, dtype=np.float64)
+    image_ids = np.asarray(image_ids)
+    if len(dets) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # 按 (图片, 分数降序) 排序，每张图片的框连续存放；lexsort 是稳定排序，分数相同时保持原来的顺序
+    order = np.lexsort((-dets[:, 4], image_ids))
+    boxes = dets[order, :4]
+    scores = dets[order, 4]
+    starts, ends = group_bounds(image_ids[order])
+    sizes = ends - starts
+
+    keep = np.zeros(len(order), dtype=bool)
+    keep[starts[sizes == 1]] = True
+
+    small = np.flatnonzero((sizes > 1) & (sizes <= max_group))
+    for _, index, valid in iter_padded_groups(starts, sizes, small, max_elements):
+        keep[index[_padded_nms(boxes[index], valid, thresh)]] = True
+
+    for g in np.flatnonzero(sizes > max_group):
+        s, e = starts[g], ends[g]
+        keep[s + sweep_nms(boxes[s:e], scores[s:e], thresh)] = True
+
+    return np.sort(order[keep])
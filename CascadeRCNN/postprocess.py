@@ -0,0 +1,55 @@
+# coding:utf-8
+import numpy as np
+
+# 检测器的类别 i 对应数字 i+1，类别 9 对应数字 0
+LABEL_LUT = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 0])
+DIGITS = np.array([str(i) for i in range(10)])
+
+
+def results_to_dets(results, factors=None):
+    """把一个 batch 的 mmdet 结果（每张图片 10 个类别各一个 (n, 5) 数组）一次拼成 (M, 6) 的数组。
+
+    返回 dets [x1, y1, x2, y2, score, 数字] 和每个框所属图片在 batch 中的下标。
+    factors 为每张图片预先缩放的比例，坐标除以它换算回原图。
+    """
+    arrays = [a for result in results for a in result]
+    sizes = np.array([len(a) for a in arrays], dtype=np.int64)
+    if sizes.sum() == 0:
+        return np.zeros((0, 6)), np.zeros(0, dtype=np.int64)
+
+    flat = np.concatenate(arrays).astype(np.float64)
+    classes = np.repeat(np.tile(np.arange(len(results[0])), len(results)), sizes)
+    image_ids = np.repeat(np.arange(len(results)), sizes.reshape(len(results), -1).sum(1))
+
+    dets = np.empty((len(flat), 6))
+    dets[:, :5] = flat[:, :5]
+    dets[:, 5] = LABEL_LUT[classes]
+    if factors is not None:
+        dets[:, :4] /= np.asarray(factors, dtype=np.float64)[image_ids, None]
+    return dets, image_ids
+
+
+def select_boxes(dets, image_ids, score_thr):
+    # 保留置信度 >= score_thr 的框（score_thr 可以是每个框一个阈值），并按 (图片, x1) 排序
+    mask = dets[:, 4] >= score_thr
+    dets, image_ids = dets[mask], image_ids[mask]
+    order = np.lexsort((dets[:, 0], image_ids))
+    return dets[order], image_ids[order]
+
+
+def render_codes(labels, image_ids, n_images, empty=''):
+    # 框已经按 (图片, x1) 排好序，把每张图片的数字依次拼成字符串，没有框的图片为 empty
+    labels = np.asarray(labels).astype(np.int64)
+    counts = np.bincount(image_ids, minlength=n_images)
+    if len(labels) == 0:
+        return [empty] * n_images
+
+    # 每个框在所属图片中的位置，放进 (n_images, 最大框数) 的字符表，再按列拼接
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(labels)) - starts[image_ids]
+    chars = np.full((n_images, counts.max()), '', dtype='<U1')
+    chars[image_ids, position] = DIGITS[labels]
+    codes = chars[:, 0]
+    for k in range(1, chars.shape[1]):
+        codes = np.char.add(codes, chars[:, k])
+    return np.where(counts == 0, empty, codes).tolist()
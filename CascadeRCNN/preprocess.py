@@ -1,161 +1,106 @@
 import os
+import sys
 import json
-from PIL import Image
+import shutil
+import tempfile
 
-image_path2 = "data/mchar_val/mchar_val"
-json_path2 = "data/mchar_val.json"
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.registry import DatasetRegistry
+from common.split import load_folds
+from image_sizes import scan_sizes
 
-image_path1 = "data/mchar_train (复件)/mchar_train"
+json_path2 = "data/mchar_val.json"
 json_path1 = "data/mchar_train.json"
 
-split_path = "split.json"
+# rename_val.py 生成的全局 id，图片不需要重命名或复制到同一个目录
+registry = DatasetRegistry.load("data/registry.npz")
 
-with open (split_path) as f:
-    split_d = json.load(f)
-smalllist = split_d['trainval']
-largelist = split_d['valval']
+# split_train_val.py 生成的 fold 数组，第 val_fold 折为验证集，按全局 id 直接查表
+folds = load_folds("data/folds.npy")
+val_fold = 0
+holdout = folds == val_fold
 
-d1 = {}
-d1['info'] = {}
-d1['licenses'] = []
-d1['images'] = []
-d1['annotations'] = []
-d1['categories'] = []
+# categories，数字1-9的类别为1-9，数字0的类别为10
+categories = []
+for i in range(1,10):
+    categories.append({'supercategory': str(i), 'id': i, 'name': str(i)})
+categories.append({'supercategory': str(0), 'id': 10, 'name': str(0)})
+
+
+class CocoWriter(object):
+    """边处理边写出 COCO 格式的 json，不在内存中保存整个数据集。
+
+    images 直接写入输出文件，annotations 先写到临时文件，close 时再拼接到 images 后面。
+    """
+
+    def __init__(self, path, categories):
+        self.f = open(path, 'w')
+        self.spool = tempfile.TemporaryFile('w+')
+        self.categories = categories
+        self.num_images = 0
+        self.num_annotations = 0
+        self.f.write('{"info": {}, "licenses": [], "images": [')
+
+    def add_image(self, image):
+        self.f.write((', ' if self.num_images else '') + json.dumps(image))
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        self.spool.write((', ' if self.num_annotations else '') + json.dumps(annotation))
+        self.num_annotations += 1
+
+    def close(self):
+        self.f.write('], "annotations": [')
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.f)
+        self.spool.close()
+        self.f.write('], "categories": ' + json.dumps(self.categories) + '}')
+        self.f.close()
+
+
+def convert(json_path, source, holdout, train_writer, val_writer, index):
+    """一次遍历标注文件，同时写出每张图片和它的标注，holdout[id] 为 True 的图片分到验证集，其余为训练集。
+
+    图片的 id 和 file_name（相对 data/ 的路径，mmdetection 的 img_prefix 设为 data/）都由 registry 给出，
+    index 为第一个标注的 id，返回下一个可用的 id。
+    """
+    sizes = scan_sizes(os.path.join(registry.root, registry.dirs[registry.source_index(source)]))
+    with open(json_path) as f:
+        load_dic = json.load(f)
+    image_ids = registry.ids(source, list(load_dic.keys()))
+    for (pic_name, label), image_id in zip(load_dic.items(), image_ids.tolist()):
+        w, h = sizes[pic_name]
+        writer = val_writer if holdout[image_id] else train_writer
+        writer.add_image({'id': image_id, 'file_name': registry.relpath(image_id), 'width': w, 'height': h})
+
+        for left, top, width, height, l in zip(label['left'], label['top'], label['width'],
+                                                label['height'], label['label']):
+            writer.add_annotation({'image_id': image_id,
+                                   'segmentation': [],
+                                   'iscrowd': 0,
+                                   'category_id': 10 if l == 0 else l,
+                                   'id': index,
+                                   'bbox': [left, top, width, height],
+                                   'area': width * height})
+            index += 1
+    return index
 
-d2 = {}
-d2['info'] = {}
-d2['licenses'] = []
-d2['images'] = []
-d2['annotations'] = []
-d2['categories'] = []
 
-# categories
-for i in range(1,10):
-    temp = {}
-    temp['supercategory'] = str(i)
-    temp['id'] = i
-    temp['name'] = str(i)
-    d1['categories'].append(temp)
-    d2['categories'].append(temp)
-temp = {}
-temp['supercategory'] = str(0)
-temp['id'] = 10
-temp['name'] = str(0)
-d1['categories'].append(temp)
-d2['categories'].append(temp)
+d1 = CocoWriter("data/newtrain.json", categories)
+d2 = CocoWriter("data/newval.json", categories)
 
 """
 处理train
 """
-# images
-piclist = os.listdir(image_path1)
-for pic_name in piclist:
-    pic_path = os.path.join(image_path1, pic_name)
-    w,h = Image.open(pic_path).size
-    temp = {}
-    if pic_name == '000000.png':
-        temp['id'] = 0
-    else:
-        temp['id'] = int(str(pic_name.split('.')[0]))
-    temp['file_name'] = pic_name
-    temp['width'] = w
-    temp['height'] = h
-    if pic_name in split_d['trainval']:
-        d2['images'].append(temp)
-    else:
-        d1['images'].append(temp)
-
-index = 0
-#annotations
-with open (json_path1) as f:
-    load_dic = json.load(f)
-    for pic_name in load_dic.keys():
-        heightlist = load_dic[pic_name]['height']
-        labellist = load_dic[pic_name]['label']
-        leftlist = load_dic[pic_name]['left']
-        toplist = load_dic[pic_name]['top']
-        widthlist = load_dic[pic_name]['width']
-
-        n = len(labellist)
-        for i in range(n):
-            box = [leftlist[i],toplist[i],widthlist[i],heightlist[i]]
-            temp = {}
-            if pic_name == '000000.png':
-                temp['image_id'] = 0
-            else:
-                temp['image_id'] = int(str(pic_name.split('.')[0]))
-            temp['segmentation'] = []
-            temp['iscrowd'] = 0
-            if labellist[i] == 0:
-                temp['category_id'] = 10
-            else:
-                temp['category_id'] = labellist[i]
-            temp['id'] = index
-            index += 1
-            temp['bbox'] = box
-            temp['area'] = widthlist[i]*heightlist[i]
-
-            if pic_name in split_d['trainval']:
-                d2['annotations'].append(temp)
-            else:
-                d1['annotations'].append(temp)
+index = convert(json_path1, 'train', holdout, d1, d2, 0)
 
 """
 处理val
 """
-# images
-piclist = os.listdir(image_path2)
-for pic_name in piclist:
-    pic_path = os.path.join(image_path2, pic_name)
-    w,h = Image.open(pic_path).size
-    temp = {}
-    temp['id'] = int(str(pic_name.split('.')[0]))
-    temp['file_name'] = pic_name
-    temp['width'] = w
-    temp['height'] = h
-    if pic_name in split_d['valval']:
-        d2['images'].append(temp)
-    else:
-        d1['images'].append(temp)
-
-#annotations
-with open (json_path2) as f:
-    load_dic = json.load(f)
-    for pic_name in load_dic.keys():
-        heightlist = load_dic[pic_name]['height']
-        labellist = load_dic[pic_name]['label']
-        leftlist = load_dic[pic_name]['left']
-        toplist = load_dic[pic_name]['top']
-        widthlist = load_dic[pic_name]['width']
-
-        n = len(labellist)
-        for i in range(n):
-            box = [leftlist[i],toplist[i],widthlist[i],heightlist[i]]
-            temp = {}
-            indexno = pic_name.split('.')[0]
-            indexno = '03' + indexno[2:]
-            newpic_name = f"{indexno}.png"
-            temp['image_id'] = int(str(newpic_name.split('.')[0]))
-            temp['segmentation'] = []
-            temp['iscrowd'] = 0
-            if labellist[i] == 0:
-                temp['category_id'] = 10
-            else:
-                temp['category_id'] = labellist[i]
-            temp['id'] = index
-            index += 1
-            temp['bbox'] = box
-            temp['area'] = widthlist[i]*heightlist[i]
-
-            if newpic_name in split_d['valval']:
-                d2['annotations'].append(temp)
-            else:
-                d1['annotations'].append(temp)
+index = convert(json_path2, 'val', holdout, d1, d2, index)
 
-print("train:",len(d1['images']))
-print("val:",len(d2['images']))
+print("train:",d1.num_images)
+print("val:",d2.num_images)
 
-with open("data/newtrain.json","w") as f:
-    json.dump(d1,f)
-with open("data/newval.json","w") as f:
-    json.dump(d2,f)
\ No newline at end of file
+d1.close()
+d2.close()
@@ -1,12 +1,14 @@
 import os
-path = 'data/mchar_val/mchar_val'
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.registry import DatasetRegistry
 
-files = os.listdir(path)
+# 不再在磁盘上重命名验证集图片：训练集和验证集的图片由 registry 分配全局 id 区分，
+# val 的 000123.png 的 id 为 30123，与以前重命名成 030123.png 后的编号相同
+registry = DatasetRegistry([('train', 'mchar_train/mchar_train'),
+                            ('val', 'mchar_val/mchar_val')], root='data')
+registry.save('data/registry.npz')
 
-for file in files:
-    old = os.path.join(path,file)
-    index = file.split('.')[0]
-    index = '03' + index[2:]
-    newpic = f"{index}.png"
-    new = os.path.join(path,newpic)
-    os.rename(old,new)
\ No newline at end of file
+for source in registry.sources:
+    ids = registry.source_ids(source)
+    print(f"{source}: {len(ids)} images, id {ids[0]}-{ids[-1]}")
@@ -1,31 +1,28 @@
 import os
+import sys
 import json
-import random
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.registry import DatasetRegistry
+from common.split import label_lengths, stratified_folds, save_folds
 
-image_path1 = "data/mchar_train (复件)/mchar_train"
-image_path2 = "data/mchar_val/mchar_val"
+json_path1 = "data/mchar_train.json"
+json_path2 = "data/mchar_val.json"
+# 分成10折，preprocess.py 取第 val_fold 折（约10%）做验证集；每次训练换一个 seed 或 val_fold 即可重新划分
+n_splits = 10
+seed = 0
 
-d={}
-d['trainval'] = []
-d['valval'] = []
+# rename_val.py 生成的全局 id
+registry = DatasetRegistry.load('data/registry.npz')
 
-piclist = os.listdir(image_path1)
-for pic in piclist:
-    r=random.random()
-    if r<=0.1:
-        d['trainval'].append(pic)
+# 按全局 id 的顺序取出每张图片的字符个数，按长度分层划分，各折中长度 1-6 的比例一致
+labels = {}
+for source, json_path in [('train', json_path1), ('val', json_path2)]:
+    with open(json_path) as f:
+        labels[source] = json.load(f)
+lengths = label_lengths([labels[source][name]['label'] for source, name in map(registry.key, range(len(registry)))])
 
-piclist = os.listdir(image_path2)
-for pic in piclist:
-    r = random.random()
-    if r <= 0.1:
-        index = pic.split('.')[0]
-        index = '03' + index[2:]
-        newpic = f"{index}.png"
-        d['valval'].append(newpic)
+folds = stratified_folds(lengths, n_splits, seed)
+save_folds('data/folds.npy', folds)
 
-print('trainval:',len(d['trainval']))
-print('valval:',len(d['valval']))
-
-with open('split.json','w') as f:
-    json.dump(d,f)
\ No newline at end of file
+for k in range(n_splits):
+    print(f'fold {k}:', int((folds == k).sum()))
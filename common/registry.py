@@ -0,0 +1,106 @@
+# coding:utf-8
+import os
+import fnmatch
+
+import numpy as np
+
+
+class DatasetRegistry(object):
+    """给多个图片目录中的 (source, 文件名) 分配稳定的全局整数 id，不需要重命名或复制文件。
+
+    sources 为 [(source, 目录), ...]，每个目录的文件名排序后依次编号，
+    第 k 个 source 的 id 从前面各 source 的图片总数开始。例如 train(30000张) + val(10000张) 时，
+    train 的 000123.png 为 123，val 的 000123.png 为 30123（与以前重命名成 030123.png 的编号相同）。
+    目录可以是相对 root 的路径，root 为空时为相对当前目录的路径。只收录与 pattern 匹配的文件，
+    目录中的 .DS_Store、<目录名>_sizes.json 等其他文件不会分配 id。
+    """
+
+    def __init__(self, sources, root='', names=None, pattern='*.png'):
+        self.sources = [source for source, _ in sources]
+        self.dirs = [path for _, path in sources]
+        self.root = root
+        if names is None:
+            names = [sorted(fnmatch.filter(os.listdir(os.path.join(root, path)), pattern)) for path in self.dirs]
+        # 所有文件名按 source 依次拼成一个定长字符串数组，offsets[k]:offsets[k+1] 为第 k 个 source
+        self.names = [np.asarray(n, dtype=str) for n in names]
+        self.offsets = np.zeros(len(self.sources) + 1, dtype=np.int64)
+        np.cumsum([len(n) for n in self.names], out=self.offsets[1:])
+        self._lookup = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def save(self, path):
+        np.savez(path, sources=np.array(self.sources), dirs=np.array(self.dirs), root=np.array(self.root),
+                 names=np.concatenate(self.names) if len(self) else np.zeros(0, dtype=str),
+                 offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        offsets = data['offsets']
+        names = [data['names'][offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)]
+        return cls(list(zip(data['sources'].tolist(), data['dirs'].tolist())), str(data['root']), names)
+
+    def source_index(self, source):
+        if source not in self.sources:
+            raise ValueError('unknown source {0}, expected one of {1}'.format(source, self.sources))
+        return self.sources.index(source)
+
+    def id(self, source, filename):
+        # 单个查询用字典，O(1)
+        if self._lookup is None:
+            self._lookup = {(s, n): int(self.offsets[k]) + i
+                            for k, s in enumerate(self.sources) for i, n in enumerate(self.names[k].tolist())}
+        try:
+            return self._lookup[(source, filename)]
+        except KeyError:
+            raise ValueError('{0} is not in source {1}'.format(filename, source))
+
+    def ids(self, source, filenames):
+        # 批量查询：在排好序的文件名数组上二分查找
+        k = self.source_index(source)
+        names = self.names[k]
+        filenames = np.asarray(filenames, dtype=str)
+        pos = np.searchsorted(names, filenames)
+        found = pos < len(names)
+        found[found] = names[pos[found]] == filenames[found]
+        if not found.all():
+            raise ValueError('{0} files are not in source {1}, e.g. {2}'.format(
+                (~found).sum(), source, filenames[~found][0]))
+        return pos + self.offsets[k]
+
+    def source_ids(self, source):
+        k = self.source_index(source)
+        return np.arange(self.offsets[k], self.offsets[k + 1])
+
+    def sources_of(self, ids):
+        return np.searchsorted(self.offsets, ids, side='right') - 1
+
+    def key(self, image_id):
+        k = int(self.sources_of(image_id))
+        return self.sources[k], str(self.names[k][image_id - self.offsets[k]])
+
+    def relpath(self, image_id):
+        # 相对 root 的路径，可以直接作为 COCO 的 file_name（img_prefix 设为 root）
+        source, name = self.key(image_id)
+        return os.path.join(self.dirs[self.source_index(source)], name)
+
+    def path(self, image_id):
+        return os.path.join(self.root, self.relpath(image_id))
+
+    def paths(self, ids=None):
+        ids = np.arange(len(self)) if ids is None else np.asarray(ids, dtype=np.int64)
+        ks = self.sources_of(ids)
+        dirs = [os.path.join(self.root, d) for d in self.dirs]
+        return [os.path.join(dirs[k], self.names[k][i - self.offsets[k]])
+                for k, i in zip(ks.tolist(), ids.tolist())]
+
+
+def open_registry(path, sources, root='', pattern='*.png'):
+    # path 存在时直接读取，保证各个阶段使用同一份编号；否则按目录建立并保存
+    if os.path.exists(path):
+        return DatasetRegistry.load(path)
+    registry = DatasetRegistry(sources, root, pattern=pattern)
+    registry.save(path)
+    return registry
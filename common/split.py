@@ -0,0 +1,59 @@
+# coding:utf-8
+import os
+
+import numpy as np
+
+
+def label_lengths(labels):
+    # 每张图片的字符个数，作为分层的依据（长度 1-6 的数量很不均衡）
+    return np.array([len(label) for label in labels], dtype=np.int64)
+
+
+def stratified_folds(strata, n_splits=10, seed=0):
+    """按 strata 分层的 K 折划分，返回 uint8 的 fold 数组，folds[i] 为全局 id 为 i 的图片所在的折。
+
+    每一层内的图片用固定 seed 打乱后轮流分到各折，每层在各折中的数量最多相差 1；
+    各层的起始折依次错开，避免样本数的余数都落在前几折。
+    """
+    if n_splits > 255:
+        raise ValueError('n_splits must fit in uint8, got {0}'.format(n_splits))
+    strata = np.asarray(strata)
+    rng = np.random.RandomState(seed)
+    folds = np.zeros(len(strata), dtype=np.uint8)
+    start = 0
+    for value in np.unique(strata):
+        members = rng.permutation(np.flatnonzero(strata == value))
+        folds[members] = (start + np.arange(len(members))) % n_splits
+        start += len(members)
+    return folds
+
+
+def fold_indices(folds, n_splits=None):
+    # fold 数组 -> 每一折的 id 列表
+    folds = np.asarray(folds)
+    if n_splits is None:
+        n_splits = int(folds.max()) + 1
+    order = np.argsort(folds, kind='stable')
+    bounds = np.searchsorted(folds[order], np.arange(n_splits + 1))
+    return [order[bounds[k]:bounds[k + 1]] for k in range(n_splits)]
+
+
+def save_folds(path, folds):
+    np.save(path, np.asarray(folds, dtype=np.uint8))
+
+
+def load_folds(path):
+    return np.load(path, mmap_mode='r')
+
+
+def open_folds(path, strata, n_splits=10, seed=0):
+    # path 存在时直接读取，各个阶段使用同一份划分；否则按 strata 生成并保存
+    if os.path.exists(path):
+        folds = load_folds(path)
+        if len(folds) != len(strata) or folds.max() >= n_splits:
+            raise ValueError('{0} holds {1} images in {2} folds, expected {3} images in {4} folds'.format(
+                path, len(folds), int(folds.max()) + 1, len(strata), n_splits))
+        return folds
+    folds = stratified_folds(strata, n_splits, seed)
+    save_folds(path, folds)
+    return folds
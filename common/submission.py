@@ -0,0 +1,83 @@
+# coding:utf-8
+import os
+import csv
+
+import numpy as np
+
+HEADER = ['file_name', 'file_code']
+
+
+def read_sample(sample_path):
+    # 比赛提供的 test_A_sample_submit.csv，返回其中图片名的顺序
+    with open(sample_path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [row[0] for row in reader]
+
+
+class SubmissionWriter(object):
+    """收集每张图片的识别结果，最后按样例提交文件的顺序一次写出。
+
+    sample_path 为 test_A_sample_submit.csv，结果按其中的顺序写出，写出前检查每张图片都有且只有一个结果；
+    为 None 时不做校验，按 add 的顺序写出。
+    """
+
+    def __init__(self, sample_path=None):
+        self.names = read_sample(sample_path) if sample_path is not None else None
+        if self.names is not None:
+            self.rows = {name: i for i, name in enumerate(self.names)}
+            self.codes = np.empty(len(self.names), dtype=object)
+            self.filled = np.zeros(len(self.names), dtype=bool)
+        else:
+            self.added_names = []
+            self.added_codes = []
+
+    def add(self, names, codes):
+        # names 可以是图片路径，只取文件名
+        names = [os.path.basename(name) for name in names]
+        codes = list(codes)
+        if len(names) != len(codes):
+            raise ValueError('got {0} file names but {1} codes'.format(len(names), len(codes)))
+        if self.names is None:
+            self.added_names += names
+            self.added_codes += codes
+            return
+
+        unknown = [name for name in names if name not in self.rows]
+        if unknown:
+            raise ValueError('{0} images are not in the sample submission, e.g. {1}'.format(
+                len(unknown), unknown[0]))
+        rows = np.array([self.rows[name] for name in names], dtype=np.int64)
+        # 之前已经 add 过的，以及本次 names 中重复出现（不是第一次出现）的图片
+        dup = self.filled[rows].copy()
+        first = np.unique(rows, return_index=True)[1]
+        repeated = np.ones(len(rows), dtype=bool)
+        repeated[first] = False
+        dup |= repeated
+        if dup.any():
+            raise ValueError('duplicate results for {0} images, e.g. {1}'.format(
+                dup.sum(), names[np.flatnonzero(dup)[0]]))
+        self.codes[rows] = codes
+        self.filled[rows] = True
+
+    def write(self, path):
+        if self.names is None:
+            names, codes = self.added_names, self.added_codes
+        else:
+            if not self.filled.all():
+                missing = np.flatnonzero(~self.filled)
+                raise ValueError('{0} images have no result, e.g. {1}'.format(
+                    len(missing), self.names[missing[0]]))
+            names, codes = self.names, self.codes.tolist()
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(HEADER)
+            writer.writerows(zip(names, codes))
+
+
+def write_submission(path, names, codes, sample_path=None):
+    # 一次性写出提交文件，sample_path 不为空时按样例文件的顺序写并校验
+    writer = SubmissionWriter(sample_path)
+    writer.add(names, codes)
+    writer.write(path)